@@ -0,0 +1,156 @@
+from __future__ import unicode_literals
+
+import collections
+
+import flatcat
+import numpy as np
+
+from .lattice import LatticeScorer
+from .selection import LOGPROB_ZERO
+
+
+class BatchLatticeScorer(LatticeScorer):
+    """LatticeScorer computing words of equal length together.
+
+    The words are bucketed by length, and the Viterbi and forward
+    recursions run vectorized over each bucket. The emission costs
+    are kept in one matrix with a row per morph, and gathered
+    for each candidate morph of the bucket by its row index.
+    Viterbi costs are identical to LatticeScorer,
+    forward costs agree up to floating point summation order.
+    N-best lists (nbest > 1) are computed word by word.
+    """
+    def __init__(self, model):
+        super(BatchLatticeScorer, self).__init__(model)
+        self._trans = np.array(self.transitions, dtype=np.float64)
+        ncat = len(self.categories)
+        self._rows = {}
+        matrix = []
+        for (morph, costs) in self.emissions.items():
+            self._rows[morph] = len(matrix)
+            matrix.append(costs)
+        # extra rows for unseen single characters and disallowed morphs
+        self._unseen = len(matrix)
+        matrix.append([LOGPROB_ZERO] * ncat)
+        self._disallowed = len(matrix)
+        matrix.append([np.inf] * ncat)
+        self._emission_matrix = np.array(matrix, dtype=np.float64)
+
+    def analyze_batch(self, words, nbest=1, forward=True):
+        """Returns (viterbi, forward_cost) for each word, like analyze"""
+        if nbest > 1:
+            return [self.analyze(word, nbest, forward) for word in words]
+        results = [None] * len(words)
+        buckets = collections.defaultdict(list)
+        for (i, word) in enumerate(words):
+            buckets[len(word)].append(i)
+        for (length, positions) in buckets.items():
+            bucket = [words[i] for i in positions]
+            if length == 0:
+                analyzed = [self.analyze(word, nbest, forward)
+                            for word in bucket]
+            else:
+                analyzed = self._analyze_bucket(bucket, nbest, forward)
+            for (i, result) in zip(positions, analyzed):
+                results[i] = result
+        return results
+
+    def _analyze_all(self, words, nbest=1):
+        return self.analyze_batch(words, nbest, True)
+
+    def _morph_rows(self, words, pt, t):
+        """Emission matrix row of word[pt:t] for each word.
+        The words are of equal length, so all the morphs are too."""
+        if t - pt == 1:
+            default = self._unseen
+        else:
+            default = self._disallowed
+        get = self._rows.get
+        return np.array([get(word[pt:t], default) for word in words],
+                        dtype=np.intp)
+
+    def _analyze_bucket(self, words, nbest, forward):
+        ncat = len(self.categories)
+        wb = ncat
+        nwords = len(words)
+        length = len(words[0])
+        rows = np.arange(nwords)
+        # columns of best costs and forward costs per state,
+        # infinite for unreachable states
+        best = np.full((length + 1, nwords, ncat + 1), np.inf)
+        best[0, :, wb] = 0.0
+        fwd = np.full((length + 1, nwords, ncat + 1), np.inf)
+        fwd[0, :, wb] = 0.0
+        # backpointers (start position, previous state)
+        bp_pt = np.zeros((length + 1, nwords, ncat), dtype=np.int64)
+        bp_prev = np.zeros((length + 1, nwords, ncat), dtype=np.int64)
+        spans = [(pt, t) for t in range(1, length + 1)
+                 for pt in range(max(0, t - self.maxlen), t)]
+        morph_rows = dict((span, self._morph_rows(words, *span))
+                          for span in spans)
+        for t in range(1, length + 1):
+            col = np.full((nwords, ncat), np.inf)
+            fwd_costs = []
+            for pt in range(max(0, t - self.maxlen), t):
+                emission = self._emission_matrix[morph_rows[(pt, t)]]
+                # (word, prev, cat), associated like LatticeScorer
+                trans = self._trans[None, :, :ncat] + emission[:, None, :]
+                cand = best[pt][:, :, None] + trans
+                prev = np.argmin(cand, axis=1)
+                cost = np.take_along_axis(
+                    cand, prev[:, None, :], axis=1)[:, 0, :]
+                # strict improvement: ties go to the first path found
+                better = cost < col
+                col = np.where(better, cost, col)
+                bp_pt[t] = np.where(better, pt, bp_pt[t])
+                bp_prev[t] = np.where(better, prev, bp_prev[t])
+                if forward:
+                    fwd_costs.append(fwd[pt][:, :, None] + trans)
+            best[t, :, :ncat] = col
+            if forward:
+                fwd[t, :, :ncat] = _logsumexp(
+                    np.concatenate(fwd_costs, axis=1), axis=1)
+        results = []
+        final = best[length, :, :ncat] + self._trans[:ncat, wb][None, :]
+        last = np.argmin(final, axis=1)
+        costs = final[rows, last]
+        if forward:
+            fwd_final = _logsumexp(
+                fwd[length, :, :ncat] + self._trans[:ncat, wb][None, :],
+                axis=1)
+        for b in range(nwords):
+            viterbi = None
+            if nbest > 0:
+                analysis = self._batch_backtrace(
+                    words[b], bp_pt[:, b], bp_prev[:, b], int(last[b]))
+                viterbi = [(analysis, float(costs[b]))]
+            fwd_cost = None
+            if forward:
+                fwd_cost = float(fwd_final[b])
+                if not np.isfinite(fwd_cost):
+                    fwd_cost = LOGPROB_ZERO
+            results.append((viterbi, fwd_cost))
+        return results
+
+    def _batch_backtrace(self, word, bp_pt, bp_prev, cat):
+        analysis = []
+        t = len(word)
+        while t > 0:
+            pt = int(bp_pt[t, cat])
+            analysis.append(
+                flatcat.CategorizedMorph(word[pt:t], self.categories[cat]))
+            (t, cat) = (pt, int(bp_prev[t, cat]))
+        analysis.reverse()
+        return analysis
+
+
+def _logsumexp(costs, axis):
+    """Cost of the sum of the probabilities given as costs,
+    infinite where every cost is infinite"""
+    best = np.min(costs, axis=axis)
+    finite = np.isfinite(best)
+    shift = np.where(finite, best, 0.0)
+    with np.errstate(over='ignore', invalid='ignore'):
+        total = np.sum(np.exp(np.expand_dims(shift, axis) - costs), axis=axis)
+        out = shift - np.log(total)
+    return np.where(finite, out, np.inf)
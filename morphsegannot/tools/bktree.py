@@ -0,0 +1,51 @@
+from __future__ import unicode_literals
+
+import Levenshtein
+
+
+class BKTree(object):
+    """Burkhard-Keller tree over words under edit distance.
+
+    Each word is a node, with its children keyed by their distance
+    to it, so memory is linear in the number of words.
+    Neighborhood queries only descend into the children
+    the triangle inequality does not rule out.
+    """
+    def __init__(self, words, distance=Levenshtein.distance):
+        self.words = words
+        self.distance = distance
+        self.root = None
+        # children of each node (word index), by distance
+        self._children = []
+        for i in range(len(words)):
+            self._add(i)
+
+    def _add(self, i):
+        self._children.append({})
+        if self.root is None:
+            self.root = i
+            return
+        node = self.root
+        while True:
+            d = self.distance(self.words[i], self.words[node])
+            child = self._children[node].get(d, None)
+            if child is None:
+                self._children[node][d] = i
+                return
+            node = child
+
+    def within(self, word, radius):
+        """(index, distance) of the words within radius of word"""
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            d = self.distance(word, self.words[node])
+            if d <= radius:
+                found.append((node, d))
+            for (child_d, child) in self._children[node].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        return found
@@ -0,0 +1,115 @@
+from __future__ import unicode_literals
+
+import tempfile
+
+import numpy as np
+
+
+class CondensedDistances(object):
+    """Symmetric distance matrix with a zero diagonal,
+    storing only the upper triangle.
+
+    The entries are compact unsigned integers in a flat array,
+    by default memory-mapped from a temporary file, so that
+    a large matrix need not fit in memory.
+
+    Indexing follows numpy for the patterns k_medoids uses:
+    dist[:, cols], dist[rows, :], dist[np.ix_(rows, cols)],
+    dist[rows, col] and dist[row, col]. The results are regular
+    int64 arrays, or an int64 scalar for dist[row, col].
+    """
+    def __init__(self, n, dtype=np.uint8, tmpdir=None, memmap=True):
+        self.n = n
+        self.dtype = np.dtype(dtype)
+        size = max(n * (n - 1) // 2, 1)
+        if memmap:
+            self.data = np.memmap(tempfile.TemporaryFile(dir=tmpdir),
+                                  dtype=self.dtype, mode='w+',
+                                  shape=(size,))
+        else:
+            self.data = np.zeros(size, dtype=self.dtype)
+        # offsets of the columns, see row
+        self._column_offsets = None
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    def row_offset(self, i):
+        """Position of the entry (i, i + 1) in the flat array.
+        Row i continues up to (i, n - 1)."""
+        return self.n * i - i * (i + 1) // 2
+
+    def set_row(self, i, values, first=None):
+        """Sets the entries (i, j) for j > i,
+        or only for j from first on"""
+        start = self.row_offset(i)
+        if first is not None:
+            start += first - i - 1
+        self.data[start:start + len(values)] = values
+
+    def row(self, i):
+        """Row i (by symmetry, also column i) as a dense array
+        of the compact type. Cheaper than dist[i, :]."""
+        # indexing a plain view avoids the overhead of memmap
+        data = self.data.view(np.ndarray)
+        out = np.zeros(self.n, dtype=self.dtype)
+        start = self.row_offset(i)
+        out[i + 1:] = data[start:start + self.n - i - 1]
+        # the entries (j, i) for j < i are in column i of the earlier rows
+        if self._column_offsets is None:
+            j = np.arange(self.n, dtype=np.int64)
+            self._column_offsets = self.n * j - j * (j + 1) // 2 - j - 1
+        out[:i] = data[self._column_offsets[:i] + i]
+        return out
+
+    def rows(self, rows):
+        """The rows (or columns) as a dense array of the compact type"""
+        out = np.zeros((len(rows), self.n), dtype=self.dtype)
+        for (r, i) in enumerate(rows):
+            out[r] = self.row(i)
+        return out
+
+    def __getitem__(self, key):
+        (rows, cols) = key
+        outer = isinstance(rows, slice) or isinstance(cols, slice)
+        row_scalar = np.ndim(rows) == 0 and not isinstance(rows, slice)
+        col_scalar = np.ndim(cols) == 0 and not isinstance(cols, slice)
+        rows = self._indices(rows)
+        cols = self._indices(cols)
+        if outer:
+            rows = rows.reshape(-1, 1)
+            cols = cols.reshape(1, -1)
+        out = self.lookup(rows, cols)
+        if outer and row_scalar:
+            out = out[0]
+        elif outer and col_scalar:
+            out = out[:, 0]
+        elif row_scalar and col_scalar:
+            out = out[()]
+        return out
+
+    def lookup(self, rows, cols):
+        """Distances between the (broadcast) rows and cols"""
+        (rows, cols) = np.broadcast_arrays(
+            np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))
+        low = np.minimum(rows, cols)
+        high = np.maximum(rows, cols)
+        diagonal = low == high
+        index = self.n * low - low * (low + 1) // 2 + (high - low - 1)
+        # works for 0-d (scalar) indices as well
+        index = np.where(diagonal, 0, index)
+        return np.where(diagonal, 0, self.data[index].astype(np.int64))
+
+    def _indices(self, key):
+        if isinstance(key, slice):
+            return np.arange(self.n)[key]
+        return np.asarray(key, dtype=np.int64)
+
+
+def compact_dtype(maxvalue):
+    """Smallest unsigned integer type holding maxvalue"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if maxvalue <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
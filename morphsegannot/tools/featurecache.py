@@ -0,0 +1,72 @@
+from __future__ import unicode_literals
+
+import hashlib
+import pickle
+import sqlite3
+
+# sqlite limits the number of parameters in a single query
+MAX_PARAMS = 500
+
+
+def model_fingerprint(filename, blocksize=2 ** 20):
+    """Hash of the contents of a model file,
+    for keying the features calculated with it."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fobj:
+        while True:
+            block = fobj.read(blocksize)
+            if len(block) == 0:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FeatureCache(object):
+    """Persistent cache of the model-dependent (generic) word features.
+
+    Entries are keyed by (model fingerprint, word, nbest depth,
+    forward flag) and stored in a single sqlite file,
+    so that reruns only need to calculate the missing entries.
+    """
+    def __init__(self, filename, fingerprint):
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(filename)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS features ('
+            'model TEXT, word TEXT, nbest INTEGER, forward INTEGER, '
+            'value BLOB, '
+            'PRIMARY KEY (model, word, nbest, forward))')
+        self._conn.commit()
+
+    def lookup(self, words, nbest, forward, count=True):
+        """Returns a dict from word to cached features,
+        for those of the words that are in the cache.
+        If count is False, the hits and misses are not counted."""
+        found = {}
+        for i in range(0, len(words), MAX_PARAMS):
+            batch = words[i:i + MAX_PARAMS]
+            query = (
+                'SELECT word, value FROM features '
+                'WHERE model = ? AND nbest = ? AND forward = ? '
+                'AND word IN ({})'.format(', '.join('?' * len(batch))))
+            params = [self.fingerprint, nbest, int(forward)] + list(batch)
+            for (word, value) in self._conn.execute(query, params):
+                found[word] = pickle.loads(bytes(value))
+        if count:
+            self.hits += sum(1 for word in words if word in found)
+            self.misses += sum(1 for word in words if word not in found)
+        return found
+
+    def store(self, items, nbest, forward):
+        """Stores (word, features) pairs"""
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)',
+            [(self.fingerprint, word, nbest, int(forward),
+              sqlite3.Binary(pickle.dumps(features, 2)))
+             for (word, features) in items])
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
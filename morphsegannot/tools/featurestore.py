@@ -0,0 +1,140 @@
+from __future__ import unicode_literals
+
+import array
+
+import flatcat
+import numpy as np
+
+from .selection import ScoredWord
+
+
+class FeatureStore(object):
+    """Column-oriented store of the generic word features.
+
+    Instead of a WordFeatures object (with nested dicts) per word,
+    the Viterbi cost, forward cost and uncertainty are float arrays,
+    and the 1-best analyses are morph and category ids in shared
+    buffers, with the analysis of word i at offsets[i]:offsets[i + 1].
+    Missing values (e.g. for prefiltered words) are NaN.
+
+    Metrics with score_columns(store) are scored vectorized,
+    and ScoredWords are only created for the returned top words.
+    """
+    def __init__(self):
+        self.words = []
+        self.morphs = []
+        self.categories = []
+        self._morph_ids = {}
+        self._category_ids = {}
+        self._viterbi = array.array(str('d'))
+        self._forward = array.array(str('d'))
+        self._uncertainty = array.array(str('d'))
+        self._offsets = array.array(str('l'), [0])
+        self._morph_buf = array.array(str('l'))
+        self._category_buf = array.array(str('l'))
+
+    @classmethod
+    def from_features(cls, features):
+        store = cls()
+        for wfeature in features:
+            store.add(wfeature)
+        store.freeze()
+        return store
+
+    def add(self, wfeature):
+        generic = wfeature.f['generic']
+        self.words.append(wfeature.word)
+        viterbi = generic.get('viterbi', None)
+        if viterbi is not None and len(viterbi) > 0:
+            (analysis, cost) = viterbi[0]
+            self._viterbi.append(cost)
+            for cmorph in analysis:
+                self._morph_buf.append(
+                    _intern(cmorph.morph, self._morph_ids, self.morphs))
+                self._category_buf.append(
+                    _intern(cmorph.category,
+                            self._category_ids, self.categories))
+        else:
+            self._viterbi.append(np.nan)
+        self._offsets.append(len(self._morph_buf))
+        self._forward.append(generic.get('forward_logp', np.nan))
+        self._uncertainty.append(wfeature.f.get('uncertainty', np.nan))
+
+    def freeze(self):
+        """Converts the columns to numpy arrays"""
+        self.viterbi_logp = np.frombuffer(self._viterbi, dtype=np.float64)
+        self.forward_logp = np.frombuffer(self._forward, dtype=np.float64)
+        self.uncertainty = np.frombuffer(
+            self._uncertainty, dtype=np.float64)
+        self.offsets = np.array(self._offsets, dtype=np.int64)
+        self.morph_ids = np.array(self._morph_buf, dtype=np.int32)
+        self.category_ids = np.array(self._category_buf, dtype=np.int32)
+        self.lengths = np.array([len(word) for word in self.words],
+                                dtype=np.int64)
+        # word of each position in the buffers
+        self._position_words = np.repeat(
+            np.arange(len(self.words)), np.diff(self.offsets))
+
+    def __len__(self):
+        return len(self.words)
+
+    def analysis(self, i):
+        """The 1-best analysis of word i"""
+        return [flatcat.CategorizedMorph(self.morphs[morph],
+                                         self.categories[cat])
+                for (morph, cat) in zip(
+                    self.morph_ids[self.offsets[i]:self.offsets[i + 1]],
+                    self.category_ids[self.offsets[i]:self.offsets[i + 1]])]
+
+    def _category_mask(self, categories):
+        ids = [self._category_ids[cat] for cat in categories
+               if cat in self._category_ids]
+        return np.isin(self.category_ids, ids)
+
+    def has_category(self, categories):
+        """Whether the analysis of each word has a morph
+        in one of the categories"""
+        hits = self._position_words[self._category_mask(categories)]
+        return np.bincount(hits, minlength=len(self.words)) > 0
+
+    def has_pair(self, categories):
+        """Whether the analysis of each word has two subsequent morphs
+        in the categories"""
+        mask = self._category_mask(categories)
+        pairs = mask[:-1] & mask[1:]
+        # pairs crossing a word boundary do not count
+        starts = self.offsets[1:-1]
+        starts = starts[(starts > 0) & (starts < len(mask))]
+        pairs[starts - 1] = False
+        hits = self._position_words[:-1][pairs]
+        return np.bincount(hits, minlength=len(self.words)) > 0
+
+    def top(self, scores, valid, k, descending):
+        """ScoredWords of the k best valid words, sorted like
+        AbstractMetric.rank (ties broken by the word).
+        valid may be None, meaning all words."""
+        rows = np.arange(len(self.words))
+        if valid is not None:
+            rows = rows[valid]
+        if k is not None and k < len(rows):
+            keys = scores[rows]
+            if descending:
+                keys = -keys
+            # everything tied with the kth best is a candidate
+            kth = np.partition(keys, k - 1)[k - 1]
+            rows = rows[keys <= kth]
+        scored = [ScoredWord(score, self.words[i])
+                  for (score, i) in zip(scores[rows].tolist(), rows)]
+        scored.sort(reverse=descending)
+        if k is not None:
+            scored = scored[:k]
+        return scored
+
+
+def _intern(value, ids, values):
+    try:
+        return ids[value]
+    except KeyError:
+        ids[value] = len(values)
+        values.append(value)
+        return ids[value]
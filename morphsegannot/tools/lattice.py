@@ -0,0 +1,209 @@
+from __future__ import unicode_literals
+
+import math
+
+import flatcat
+
+from .selection import LOGPROB_ZERO
+
+
+class LatticeScorer(object):
+    """Computes the Viterbi analyses (n-best) and the forward cost
+    of a word in a single pass over its HMM lattice.
+
+    The emission costs of the lexicon and the transition costs
+    are read from the model once.
+    Costs are negative log probabilities, as in flatcat.
+    """
+    def __init__(self, model):
+        self.categories = list(model.get_categories(wb=False))
+        # the word boundary is the extra category
+        self.wb = [cat for cat in model.get_categories(wb=True)
+                   if cat not in self.categories][0]
+        coding = model._corpus_coding
+        labels = self.categories + [self.wb]
+        # transitions[prev][next], indexed like labels
+        self.transitions = [
+            [coding.log_transitionprob(prev, nxt) for nxt in labels]
+            for prev in labels]
+        self.emissions = {}
+        self.maxlen = 1
+        for (morph, _) in model.get_lexicon():
+            self.emissions[morph] = [
+                coding.log_emissionprob(cat, morph)
+                for cat in self.categories]
+            self.maxlen = max(self.maxlen, len(morph))
+
+    def analyze(self, word, nbest=1, forward=True):
+        """Returns (viterbi, forward_cost).
+
+        viterbi is a list of the nbest (analysis, cost) pairs,
+        or None if nbest is 0. forward_cost is None if not requested.
+        """
+        columns = [self.initial_column(nbest, forward)]
+        for t in range(1, len(word) + 1):
+            columns.append(self.column(word, t, columns, nbest, forward))
+        return self.finish(word, columns, nbest, forward)
+
+    def initial_column(self, nbest, forward):
+        """The column before the first character:
+        only the word boundary state is reachable."""
+        wb = len(self.categories)
+        best = [[] for _ in range(wb + 1)]
+        best[wb] = [(0.0, None, None, None)]
+        fwd = None
+        if forward:
+            # None marks unreachable states
+            fwd = [None] * (wb + 1)
+            fwd[wb] = 0.0
+        return (best, fwd)
+
+    def column(self, word, t, columns, nbest, forward):
+        """Computes the lattice column ending at position t.
+        Depends only on word[:t] and the earlier columns."""
+        wb = len(self.categories)
+        keep = max(nbest, 1)
+        best = [[] for _ in range(wb + 1)]
+        fwd = None
+        if forward:
+            fwd = [None] * (wb + 1)
+        for cat in range(wb):
+            candidates = []
+            fwd_costs = []
+            for pt in range(max(0, t - self.maxlen), t):
+                emission = self._emission(word[pt:t], cat)
+                if emission is None:
+                    continue
+                (prev_best, prev_fwd) = columns[pt]
+                for prev in range(wb + 1):
+                    trans = self.transitions[prev][cat] + emission
+                    for (rank, entry) in enumerate(prev_best[prev]):
+                        candidates.append((entry[0] + trans, pt, prev, rank))
+                    if forward and prev_fwd[prev] is not None:
+                        fwd_costs.append(prev_fwd[prev] + trans)
+            # stable sort: ties go to the first path found
+            candidates.sort(key=lambda x: x[0])
+            best[cat] = candidates[:keep]
+            if forward and len(fwd_costs) > 0:
+                fwd[cat] = _logsumexp(fwd_costs)
+        return (best, fwd)
+
+    def finish(self, word, columns, nbest, forward):
+        """Adds the final transition to the word boundary,
+        and follows the backpointers of the best paths."""
+        wb = len(self.categories)
+        t = len(word)
+        (last_best, last_fwd) = columns[t]
+        viterbi = None
+        if nbest > 0:
+            candidates = []
+            for cat in range(wb):
+                trans = self.transitions[cat][wb]
+                for (rank, entry) in enumerate(last_best[cat]):
+                    candidates.append((entry[0] + trans, cat, rank))
+            candidates.sort(key=lambda x: x[0])
+            viterbi = [(self._backtrace(word, columns, t, cat, rank), cost)
+                       for (cost, cat, rank) in candidates[:nbest]]
+        fwd_cost = None
+        if forward:
+            fwd_cost = _logsumexp(
+                [last_fwd[cat] + self.transitions[cat][wb]
+                 for cat in range(wb)
+                 if last_fwd[cat] is not None])
+        return (viterbi, fwd_cost)
+
+    def agrees(self, model, words, tolerance=1e-6, nbest=1):
+        """Checks that the scorer gives the same results as the model.
+        If nbest > 1, the n-best lists are also compared,
+        including the order of tied analyses."""
+        results = self._analyze_all(words, max(nbest, 1))
+        for (word, result) in zip(words, results):
+            (viterbi, fwd_cost) = result
+            (morphs, cost) = model.viterbi_analyze(word)
+            if list(morphs) != list(viterbi[0][0]):
+                return False
+            if abs(cost - viterbi[0][1]) > tolerance:
+                return False
+            if abs(model.forward_logprob(word) - fwd_cost) > tolerance:
+                return False
+            if nbest > 1:
+                expected = model.viterbi_nbest(word, nbest)
+                if len(expected) != len(viterbi):
+                    return False
+                for ((morphs, cost), (analysis, acost)) in zip(
+                        expected, viterbi):
+                    if list(morphs) != list(analysis):
+                        return False
+                    if abs(cost - acost) > tolerance:
+                        return False
+        return True
+
+    def _analyze_all(self, words, nbest=1):
+        return [self.analyze(word, nbest, True) for word in words]
+
+    def _emission(self, morph, cat):
+        # Unseen morphs are only allowed as single characters,
+        # so that every word has an analysis.
+        try:
+            return self.emissions[morph][cat]
+        except KeyError:
+            if len(morph) == 1:
+                return LOGPROB_ZERO
+            return None
+
+    def _backtrace(self, word, columns, t, cat, rank):
+        analysis = []
+        while t > 0:
+            (_, pt, prev, prev_rank) = columns[t][0][cat][rank]
+            analysis.append(
+                flatcat.CategorizedMorph(word[pt:t], self.categories[cat]))
+            (t, cat, rank) = (pt, prev, prev_rank)
+        analysis.reverse()
+        return analysis
+
+
+class PrefixLatticeScorer(LatticeScorer):
+    """LatticeScorer sharing the lattice columns of common prefixes.
+
+    The words of a batch are analyzed in sorted order,
+    which walks their character trie depth first:
+    the columns of the prefix shared with the previous word
+    are kept, and only the rest of the word is computed.
+    """
+    # Selector sorts the pool for scorers with this set
+    prefix_sharing = True
+
+    def analyze_batch(self, words, nbest=1, forward=True):
+        """Returns (viterbi, forward_cost) for each word, like analyze"""
+        results = [None] * len(words)
+        columns = [self.initial_column(nbest, forward)]
+        prev = ''
+        for i in sorted(range(len(words)), key=words.__getitem__):
+            word = words[i]
+            shared = _common_prefix(prev, word)
+            del columns[shared + 1:]
+            for t in range(shared + 1, len(word) + 1):
+                columns.append(self.column(word, t, columns, nbest, forward))
+            results[i] = self.finish(word, columns, nbest, forward)
+            prev = word
+        return results
+
+    def _analyze_all(self, words, nbest=1):
+        return self.analyze_batch(words, nbest, True)
+
+
+def _common_prefix(first, second):
+    """Length of the common prefix of the two strings"""
+    length = min(len(first), len(second))
+    for i in range(length):
+        if first[i] != second[i]:
+            return i
+    return length
+
+
+def _logsumexp(costs):
+    """Cost of the sum of the probabilities given as costs"""
+    if len(costs) == 0:
+        return LOGPROB_ZERO
+    best = min(costs)
+    return best - math.log(sum(math.exp(best - cost) for cost in costs))
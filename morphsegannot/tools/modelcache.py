@@ -0,0 +1,55 @@
+from __future__ import unicode_literals
+
+import errno
+import os
+import pickle
+import sys
+import time
+
+from .featurecache import model_fingerprint
+
+
+def load_model(io, filename, cachedir=None):
+    """Reads a model tarball and initializes its HMM.
+
+    If cachedir is given, the initialized model is stored there
+    as a pickled snapshot, named by the hash of the tarball contents.
+    Later loads of the same tarball read the snapshot instead,
+    skipping both the tarball parsing and initialize_hmm.
+    """
+    start = time.time()
+    snapshot = None
+    if cachedir is not None:
+        # pickles are not portable between python versions
+        snapshot = os.path.join(cachedir, '{}.py{}.model.pickle'.format(
+            model_fingerprint(filename), sys.version_info[0]))
+        if os.path.exists(snapshot):
+            with open(snapshot, 'rb') as fobj:
+                model = pickle.load(fobj)
+            print('Loaded model snapshot "{}" in {:.1f}s'.format(
+                snapshot, time.time() - start))
+            return model
+    model = io.read_tarball_model_file(filename)
+    model.initialize_hmm()
+    print('Loaded model "{}" in {:.1f}s'.format(
+        filename, time.time() - start))
+    if snapshot is not None:
+        # written under a temporary name, as concurrent runs
+        # may be loading the same model
+        tmp = '{}.{}.tmp'.format(snapshot, os.getpid())
+        try:
+            try:
+                os.makedirs(cachedir)
+            except OSError as e:
+                # another run may have created it
+                if e.errno != errno.EEXIST:
+                    raise
+            with open(tmp, 'wb') as fobj:
+                pickle.dump(model, fobj, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, snapshot)
+        except Exception as e:
+            # the snapshot is only an optimization
+            print('Could not write model snapshot: {}'.format(e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return model
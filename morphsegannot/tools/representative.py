@@ -1,30 +1,124 @@
 from __future__ import unicode_literals
 
+import heapq
+
 import Levenshtein
 import numpy as np
 
-def representative_sampling(words, k):
-    dist = distances(words)
-    medoids, _ = best_of(dist, k)
+from .bktree import BKTree
+from .distmatrix import CondensedDistances, compact_dtype
+from .selection import _fork_pool
+
+# algorithms working on a distance matrix (see kmedoids)
+MATRIX_ALGORITHMS = ('voronoi', 'fasterpam')
+# these do not need the matrix (see clara and bktree_medoids)
+ALGORITHMS = MATRIX_ALGORITHMS + ('clara', 'bktree')
+
+def representative_sampling(words, k, tmpdir=None, workers=1,
+                            algorithm='voronoi', seed=None, radius=3):
+    if algorithm == 'bktree':
+        medoids = bktree_medoids(words, k, radius)
+    elif algorithm == 'clara':
+        medoids = clara(words, k, seed=seed)
+    else:
+        dist = distances(words, tmpdir=tmpdir, workers=workers)
+        medoids, _ = kmedoids(dist, k, algorithm, seed, workers)
     for m in medoids:
         yield words[m]
 
 
-def distances(words):
-    # symmetry is wasted
-    dist = Levenshtein.compare_lists(words, words, 0.0, 0)
+def kmedoids(dist, k, algorithm='voronoi', seed=None, workers=1):
+    """Clusters with one of the MATRIX_ALGORITHMS,
+    returning (medoids, clusters).
+
+    voronoi: best_of the random restarts of k_medoids.
+    fasterpam: BUILD initialization and FasterPAM swaps.
+    Both minimize the sum of squared distances to the medoids,
+    as does clara, which needs no matrix.
+    """
+    if algorithm == 'voronoi':
+        return best_of(dist, k, seed=seed, workers=workers)
+    if algorithm == 'fasterpam':
+        medoids = fasterpam(dist, build(dist, k),
+                            np.random.RandomState(seed))
+    else:
+        raise Exception('Unknown k-medoids algorithm "{}"'.format(algorithm))
+    return (medoids, assign(dist, medoids))
+
+
+def distances(words, tmpdir=None, blocksize=256, workers=1,
+              tilesize=8192):
+    """Edit distances between the words, as a CondensedDistances
+    (upper triangle only) memory-mapped from a file in tmpdir.
+
+    The blocks of rows are computed in tiles of at most
+    tilesize columns, bounding the memory used by each block.
+    With several workers, the blocks are computed
+    in forked processes, writing directly into the shared mapping.
+    """
+    n = len(words)
+    # an edit distance is at most the length of the longer word
+    maxlen = max([len(word) for word in words] + [0])
+    dist = CondensedDistances(n, compact_dtype(maxlen), tmpdir=tmpdir)
+    blocks = [(start, min(start + blocksize, n), tilesize)
+              for start in range(0, n, blocksize)]
+    if workers > 1 and len(blocks) > 1:
+        _parallel_blocks(dist, words, blocks, workers)
+    else:
+        for (start, end, tilesize) in blocks:
+            _distance_block(dist, words, start, end, tilesize)
     return dist
 
 
-def k_medoids(dist, k, tmax=100):
+# matrix and words used by the worker processes
+# of distances and best_of
+_worker_dist = None
+_worker_words = None
+
+
+def _worker_block(block):
+    _distance_block(_worker_dist, _worker_words, *block)
+
+
+def _parallel_blocks(dist, words, blocks, workers):
+    global _worker_dist, _worker_words
+    (_worker_dist, _worker_words) = (dist, words)
+    pool = _fork_pool(workers)
+    try:
+        # the first rows are the longest: many small blocks
+        # keep the workers evenly loaded
+        for _ in pool.imap_unordered(_worker_block, blocks):
+            pass
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        (_worker_dist, _worker_words) = (None, None)
+    dist.data.flush()
+
+
+def _distance_block(dist, words, start, end, tilesize):
+    """Fills in the rows from start to end"""
+    # the rows against the words after the first one,
+    # each row only keeping the part above the diagonal
+    for first in range(start + 1, len(words), tilesize):
+        last = min(first + tilesize, len(words))
+        tile = np.asarray(Levenshtein.compare_lists(
+            words[start:end], words[first:last], 0.0, 0))
+        for i in range(start, min(end, last - 1)):
+            j = max(first, i + 1)
+            dist.set_row(i, tile[i - start, j - first:], j)
+
+
+def k_medoids(dist, k, tmax=100, rng=np.random):
     m, n = dist.shape
     # randomly initialize an array of k medoid indices
     medoids = np.arange(n)
-    np.random.shuffle(medoids)
+    rng.shuffle(medoids)
     medoids = medoids[:k]
     medoids_old = np.copy(medoids)
     clusters = {}
-    for t in xrange(tmax):
+    for t in range(tmax):
         # determine clusters, i.e. arrays of data indices
         J = np.argmin(dist[:, medoids], axis=1)
         for current in range(k):
@@ -52,13 +146,272 @@ def k_medoids(dist, k, tmax=100):
     return medoids, clusters, wcvars
 
 
-def best_of(dist, k, tmax=100, repeats=10):
+def best_of(dist, k, tmax=100, repeats=10, seed=None, workers=1):
+    """Best of repeated k_medoids, each seeded from the master seed.
+    With several workers, the restarts run in forked processes
+    sharing the distance matrix. Ties go to the earliest restart,
+    so the result only depends on the seed."""
+    seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=repeats)
+    tasks = [(dist, k, tmax, restart_seed) for restart_seed in seeds]
+    if workers > 1 and repeats > 1:
+        results = _parallel_restarts(tasks, workers)
+    else:
+        results = [_restart(task) for task in tasks]
     best = None
     cost = None
-    for _ in xrange(repeats):
-        medoids, clusters, wcvars = k_medoids(dist, k, tmax)
-        cost_new = np.sum(wcvars)
+    for (cost_new, medoids, clusters) in results:
         if cost is None or cost_new < cost:
             best = (medoids, clusters)
             cost = cost_new
     return best
+
+
+def _restart(task):
+    (dist, k, tmax, seed) = task
+    medoids, clusters, wcvars = k_medoids(
+        dist, k, tmax, np.random.RandomState(seed))
+    return (np.sum(wcvars), medoids, clusters)
+
+
+def _worker_restart(task):
+    return _restart((_worker_dist,) + task)
+
+
+def _parallel_restarts(tasks, workers):
+    global _worker_dist
+    # the matrix is inherited through fork, not pickled to the workers
+    _worker_dist = tasks[0][0]
+    pool = _fork_pool(workers)
+    try:
+        results = pool.map(_worker_restart,
+                           [task[1:] for task in tasks])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_dist = None
+    return results
+
+
+def build(dist, k, blocksize=2 ** 22):
+    """BUILD initialization of PAM: greedily adds the medoid
+    reducing the cost the most.
+
+    The cost of adding each candidate is kept up to date,
+    only reading the rows of the points whose nearest medoid
+    changed, at most blocksize matrix entries at a time."""
+    n = dist.shape[0]
+    k = min(k, n)
+    step = max(1, blocksize // max(n, 1))
+    cost = np.zeros(n, dtype=np.int64)
+    largest = 0
+    dtype = np.int64
+    for start in range(0, n, step):
+        sq = _squared_rows(dist, np.arange(start, min(start + step, n)))
+        cost += sq.sum(axis=0, dtype=np.int64)
+        largest = max(largest, sq.max())
+        dtype = sq.dtype
+    # squared distance to the nearest medoid: before the first
+    # medoid, the largest one, so that it never is the minimum
+    nearest = np.zeros(n, dtype=dtype) + largest
+    medoids = []
+    is_medoid = np.zeros(n, dtype=bool)
+    while len(medoids) < k:
+        best = np.argmin(np.where(is_medoid, np.iinfo(np.int64).max, cost))
+        medoids.append(best)
+        is_medoid[best] = True
+        if len(medoids) == k:
+            break
+        closer = _squared_rows(dist, [best])[0]
+        changed = np.where(closer < nearest)[0]
+        for start in range(0, len(changed), step):
+            points = changed[start:start + step]
+            sq = _squared_rows(dist, points)
+            gain = (np.minimum(sq, nearest[points, None])
+                    - np.minimum(sq, closer[points, None]))
+            cost -= gain.sum(axis=0, dtype=np.int64)
+        nearest = np.minimum(nearest, closer)
+    return np.array(medoids, dtype=np.int64)
+
+
+def fasterpam(dist, medoids, rng=None, max_passes=100):
+    """Improves the medoids with FasterPAM (Schubert & Rousseeuw 2021):
+    the candidates are scanned in (random) order, and every swap
+    that lowers the cost is done eagerly. Stops after a full pass
+    over the candidates without a swap.
+
+    The nearest and second nearest medoids are updated after
+    each swap, only recomputed for the points that lost one."""
+    n = dist.shape[0]
+    medoids = np.array(medoids, dtype=np.int64)
+    k = len(medoids)
+    if k < 2 or k >= n:
+        # BUILD is already optimal for a single medoid
+        return medoids
+    is_medoid = np.zeros(n, dtype=bool)
+    is_medoid[medoids] = True
+    (near, second, d1, d2) = _nearest_two(
+        _squared_rows(dist, medoids).T)
+    loss = np.bincount(near, weights=(d2 - d1), minlength=k)
+    order = np.arange(n)
+    if rng is not None:
+        rng.shuffle(order)
+    last_swap = None
+    for _ in range(max_passes):
+        for c in order:
+            if c == last_swap:
+                return medoids
+            if is_medoid[c]:
+                continue
+            dc = _squared_rows(dist, [c])[0]
+            # change if c is added, and for removing each medoid
+            closer = dc < d1
+            shared = np.sum(dc[closer] - d1[closer], dtype=np.int64)
+            between = ~closer & (dc < d2)
+            delta = (loss + shared
+                     + np.bincount(near[closer],
+                                   weights=(d1 - d2)[closer], minlength=k)
+                     + np.bincount(near[between],
+                                   weights=(dc - d2)[between], minlength=k))
+            i = np.argmin(delta)
+            if delta[i] < 0:
+                is_medoid[medoids[i]] = False
+                is_medoid[c] = True
+                medoids[i] = c
+                _swap_nearest(dist, medoids, i, dc, near, second, d1, d2)
+                loss = np.bincount(near, weights=(d2 - d1), minlength=k)
+                last_swap = c
+        if last_swap is None:
+            break
+    return medoids
+
+
+def clara(words, k, samples=5, samplesize=None, seed=None, blocksize=8192):
+    """CLARA: clusters random samples (including the best medoids
+    so far) with fasterpam, keeping the medoids with the lowest
+    cost on all of the words.
+
+    No full distance matrix is needed: only the distances within
+    each sample, and from all words to its medoids (blocksize
+    words at a time) are computed."""
+    rng = np.random.RandomState(seed)
+    n = len(words)
+    k = min(k, n)
+    if samplesize is None:
+        samplesize = 40 + 2 * k
+    samplesize = min(max(samplesize, k), n)
+    best = None
+    best_cost = None
+    for _ in range(samples):
+        others = rng.permutation(n)
+        if best is not None:
+            others = others[~np.isin(others, best)]
+            sample = np.concatenate([best, others[:samplesize - k]])
+        else:
+            sample = others[:samplesize]
+        sample = np.sort(sample)
+        sample_words = [words[i] for i in sample]
+        sub = _edit_distances(sample_words, sample_words)
+        medoids = sample[fasterpam(sub, build(sub, k), rng)]
+        medoid_words = [words[i] for i in medoids]
+        cost = 0
+        for start in range(0, n, blocksize):
+            cost += int(np.sum(np.min(_edit_distances(
+                words[start:start + blocksize], medoid_words), axis=1) ** 2))
+        if best_cost is None or cost < best_cost:
+            (best, best_cost) = (medoids, cost)
+    return best
+
+
+def bktree_medoids(words, k, radius=3):
+    """Matrix-free medoid selection, with memory linear in the words.
+
+    Greedily adds the medoid reducing the most the sum of
+    distances to the nearest medoid, with distances truncated
+    at radius + 1 (like BUILD on the truncated distances).
+    Only neighborhoods within radius are needed, which are
+    queried from a BKTree. As the reductions can only shrink,
+    they are reevaluated lazily from a max-heap.
+    Ties go to the earlier word.
+    """
+    n = len(words)
+    k = min(k, n)
+    tree = BKTree(words)
+    nearest = np.zeros(n, dtype=np.int64) + radius + 1
+
+    def gain(neighbors):
+        return sum(max(0, nearest[v] - d) for (v, d) in neighbors)
+
+    heap = [(-gain(tree.within(words[i], radius)), i) for i in range(n)]
+    heapq.heapify(heap)
+    medoids = []
+    while len(medoids) < k:
+        (_, i) = heapq.heappop(heap)
+        neighbors = tree.within(words[i], radius)
+        entry = (-gain(neighbors), i)
+        if len(heap) > 0 and entry > heap[0]:
+            # no longer the best
+            heapq.heappush(heap, entry)
+            continue
+        medoids.append(i)
+        for (v, d) in neighbors:
+            nearest[v] = min(nearest[v], d)
+    return np.array(medoids, dtype=np.int64)
+
+
+def total_cost(dist, medoids):
+    """Sum of the squared distances to the nearest medoid"""
+    nearest = np.min(_squared_rows(dist, medoids), axis=0)
+    return int(np.sum(nearest, dtype=np.int64))
+
+
+def assign(dist, medoids):
+    """Clusters (as in k_medoids) of the nearest medoids"""
+    nearest = np.argmin(_squared_rows(dist, medoids), axis=0)
+    return dict((current, np.where(nearest == current)[0])
+                for current in range(len(medoids)))
+
+
+def _squared_rows(dist, rows):
+    """Squared distances of the rows (or, as the matrix is
+    symmetric, columns) to all points"""
+    if isinstance(dist, CondensedDistances):
+        rows = dist.rows(rows)
+    else:
+        rows = np.asarray(dist)[np.asarray(rows, dtype=np.int64)]
+    # the squares of byte-sized distances fit in int32,
+    # which halves the memory traffic
+    if rows.dtype.itemsize == 1:
+        return rows.astype(np.int32) ** 2
+    return rows.astype(np.int64) ** 2
+
+
+def _edit_distances(first, second):
+    return np.asarray(Levenshtein.compare_lists(
+        first, second, 0.0, 0)).astype(np.int64)
+
+
+def _nearest_two(sq):
+    """For each point, given its squared distances to the medoids:
+    the positions of the nearest and second nearest medoid,
+    and the squared distances to them"""
+    order = np.argsort(sq, axis=1, kind='mergesort')[:, :2]
+    rows = np.arange(sq.shape[0])
+    (near, second) = (order[:, 0], order[:, 1])
+    return (near, second, sq[rows, near], sq[rows, second])
+
+
+def _swap_nearest(dist, medoids, i, dc, near, second, d1, d2):
+    """Updates (in place) the nearest two medoids after medoid i
+    was replaced, dc being the squared distances to the new one"""
+    lost = (near == i) | (second == i)
+    closer = ~lost & (dc < d1)
+    between = ~lost & ~closer & (dc < d2)
+    (second[between], d2[between]) = (i, dc[between])
+    (second[closer], d2[closer]) = (near[closer], d1[closer])
+    (near[closer], d1[closer]) = (i, dc[closer])
+    points = np.where(lost)[0]
+    if len(points) > 0:
+        sq = np.asarray(dist[np.ix_(points, medoids)]).astype(np.int64) ** 2
+        (near[points], second[points], d1[points], d2[points]) = (
+            _nearest_two(sq))
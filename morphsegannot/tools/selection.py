@@ -2,49 +2,218 @@ from __future__ import unicode_literals
 
 import codecs
 import collections
+import heapq
+import itertools
 import math
+import multiprocessing
+import pickle
 
 WordFeatures = collections.namedtuple('WordFeatures', ['word', 'f'])
 ScoredWord = collections.namedtuple('ScoredWord', ['score', 'word'])
 
 
 class Selector(object):
-    def __init__(self, metric, model, progress=None):
+    def __init__(self, metric, model, progress=None, workers=1,
+                 chunksize=500, cache=None, scorer=None, columnar=False):
         self.metric = metric
         self.model = model
         self.need_nbest = metric.need_nbest
         self.need_forward = metric.need_forward
         self._progress = progress
-
-    def calculate_features(self, words):
+        self.workers = workers
+        self.chunksize = chunksize
+        self.cache = cache
+        # computes the model features in a single lattice pass,
+        # instead of separate model calls (see lattice.LatticeScorer).
+        # Scorers with analyze_batch get whole chunks at a time.
+        self.scorer = scorer
+        self.metric.workers = workers
+        # metrics with score_columns are scored from
+        # a featurestore.FeatureStore, instead of per WordFeatures
+        self.columnar = columnar
+        # the forward cost is only computed for words passing
+        # the prefilter of the metric
+        self._metric_prefilter = None
+        if self.need_forward:
+            self._metric_prefilter = getattr(metric, 'prefilter', None)
+
+    def calculate_features(self, words, generic=None):
+        """Calculates WordFeatures for each word.
+        Optionally uses precalculated generic features,
+        given as a dict from word to features."""
+        # chunks of (word, generic features if already known)
+        chunks = _chunks(words, self.chunksize)
+        if generic is not None:
+            chunks = ([(word, generic.get(word, None)) for word in chunk]
+                      for chunk in chunks)
+        elif self._use_cache:
+            chunks = (self._lookup(chunk) for chunk in chunks)
+        else:
+            chunks = ([(word, None) for word in chunk] for chunk in chunks)
+        if self.workers > 1:
+            results = self._parallel_features(chunks)
+        else:
+            results = self._serial_features(chunks)
+        features = self._store(results)
         if self._progress is not None:
-            words = self._progress(words)
-        for word in words:
-            features = collections.defaultdict(dict)
-            viterbi = None
-            if self.need_nbest == 0:
-                pass
-            elif self.need_nbest == 1:
-                morphs, viterbi_logp = self.model.viterbi_analyze(word)
-                viterbi = [(morphs, viterbi_logp)]
-            else:
-                viterbi = self.model.viterbi_nbest(word, self.need_nbest)
-            if not viterbi is None:
-                features['generic']['viterbi'] = viterbi
-
-            if self.need_forward:
-                forward_logp = self.model.forward_logprob(word)
-                features['generic']['forward_logp'] = forward_logp
-
-                features['uncertainty'] = (
-                    features['generic']['viterbi'][0][1]
-                    - features['generic']['forward_logp'])
-
-            custom = self.metric.features(word, features)
-            if custom is not None:
-                features[self.metric.name] = custom
-
-            yield WordFeatures(word, features)
+            features = self._progress(features)
+        for wfeature in features:
+            yield wfeature
+
+    @property
+    def _use_cache(self):
+        # metrics without model features have nothing to cache
+        return (self.cache is not None
+                and (self.need_nbest > 0 or self.need_forward))
+
+    def _lookup(self, chunk):
+        cached = self.cache.lookup(
+            chunk, self.need_nbest, self.need_forward)
+        missing = [word for word in chunk if word not in cached]
+        if self._metric_prefilter is not None and len(missing) > 0:
+            # words rejected by the prefilter are cached
+            # without the forward cost
+            partial = self.cache.lookup(
+                missing, self.need_nbest, False, count=False)
+            for (word, generic) in partial.items():
+                if not self._metric_prefilter(word, generic):
+                    cached[word] = generic
+                    self.cache.hits += 1
+                    self.cache.misses -= 1
+        return [(word, cached.get(word, None)) for word in chunk]
+
+    def _store(self, results):
+        for (chunk, wfeatures) in results:
+            if self._use_cache:
+                computed = [wfeature
+                            for ((_, generic), wfeature)
+                            in zip(chunk, wfeatures)
+                            if generic is None]
+                self.cache.store(
+                    [(wfeature.word, wfeature.f['generic'])
+                     for wfeature in computed if self._complete(wfeature)],
+                    self.need_nbest, self.need_forward)
+                if self._metric_prefilter is not None:
+                    self.cache.store(
+                        [(wfeature.word, wfeature.f['generic'])
+                         for wfeature in computed
+                         if not self._complete(wfeature)],
+                        self.need_nbest, False)
+            for wfeature in wfeatures:
+                yield wfeature
+
+    def _complete(self, wfeature):
+        # prefiltered words lack the forward cost,
+        # which other metrics sharing the cache may need
+        return (not self.need_forward
+                or 'forward_logp' in wfeature.f['generic'])
+
+    def _serial_features(self, chunks):
+        for chunk in chunks:
+            yield (chunk, self._chunk_features(chunk))
+
+    def _chunk_features(self, chunk):
+        if hasattr(self.scorer, 'analyze_batch'):
+            # batch engines compute the missing model features
+            # of the whole chunk together
+            missing = [word for (word, generic) in chunk if generic is None]
+            computed = dict(zip(missing, self._batch_model_features(missing)))
+            chunk = [(word, computed[word] if generic is None else generic)
+                     for (word, generic) in chunk]
+        return [self._word_features(word, generic)
+                for (word, generic) in chunk]
+
+    def _parallel_features(self, chunks):
+        # The workers inherit the loaded model (and the metric)
+        # through fork, instead of it being pickled to them.
+        global _worker_selector
+        _worker_selector = self
+        pool = _fork_pool(self.workers)
+        try:
+            # the chunks are read (and looked up from the cache)
+            # in this thread, not by the pool
+            for (chunk, wfeatures) in _bounded_map(
+                    pool, _worker_features, chunks, 2 * self.workers):
+                yield (chunk, wfeatures)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _worker_selector = None
+
+    def _model_features(self, word):
+        """The features depending only on the model,
+        which can be cached."""
+        if self._metric_prefilter is None or self.scorer is not None:
+            # scorers compute the forward cost in the same lattice pass
+            # as the Viterbi analyses, so splitting it would only
+            # duplicate work
+            return self._analyze(word, self.need_forward)
+        generic = self._analyze(word, False)
+        if self._metric_prefilter(word, generic):
+            generic['forward_logp'] = self._analyze(word, True, 0)[
+                'forward_logp']
+        return generic
+
+    def _analyze(self, word, forward, nbest=None):
+        if nbest is None:
+            nbest = self.need_nbest
+        if nbest == 0 and not forward:
+            # e.g. cheap cascade proxies
+            return {}
+        if self.scorer is not None:
+            return self._scorer_features(
+                self.scorer.analyze(word, nbest, forward))
+        generic = {}
+        viterbi = None
+        if nbest == 0:
+            pass
+        elif nbest == 1:
+            morphs, viterbi_logp = self.model.viterbi_analyze(word)
+            viterbi = [(morphs, viterbi_logp)]
+        else:
+            viterbi = self.model.viterbi_nbest(word, nbest)
+        if not viterbi is None:
+            generic['viterbi'] = viterbi
+
+        if forward:
+            generic['forward_logp'] = self.model.forward_logprob(word)
+        return generic
+
+    def _batch_model_features(self, words):
+        if len(words) == 0:
+            return []
+        if self.need_nbest == 0 and not self.need_forward:
+            return [{} for _ in words]
+        return [self._scorer_features(result)
+                for result in self.scorer.analyze_batch(
+                    words, self.need_nbest, self.need_forward)]
+
+    def _scorer_features(self, result):
+        (viterbi, forward_logp) = result
+        generic = {}
+        if viterbi is not None:
+            generic['viterbi'] = viterbi
+        if forward_logp is not None:
+            generic['forward_logp'] = forward_logp
+        return generic
+
+    def _word_features(self, word, generic=None):
+        if generic is None:
+            generic = self._model_features(word)
+        features = collections.defaultdict(dict)
+        features['generic'] = generic
+
+        if 'forward_logp' in generic:
+            features['uncertainty'] = (
+                features['generic']['viterbi'][0][1]
+                - features['generic']['forward_logp'])
+
+        custom = self.metric.features(word, features)
+        if custom is not None:
+            features[self.metric.name] = custom
+
+        return WordFeatures(word, features)
 
     def configure(self, words, seen=None):
         try:
@@ -52,20 +221,226 @@ class Selector(object):
         except AttributeError:
             pass
 
-    def rank(self, words, seen=None, n=None):
+    def rank(self, words, seen=None, n=None, generic=None, top=None,
+             cascade=None):
+        """Ranks the words using the metric.
+
+        If top is given, only that many best words are returned.
+        Unless the metric is greedy, the features are then streamed
+        through a bounded heap instead of all being kept in memory.
+
+        For compact pools, each word type is scored once,
+        and its frequency is available as the feature 'frequency'.
+
+        cascade is an optional (proxy metric, size) pair.
+        The words are first narrowed down to the size best
+        according to the proxy, which should be cheaper to compute
+        (e.g. LogpMetric, IFSubstringMetric), and only these
+        are scored with the metric.
+
+        With columnar, metrics having score_columns are scored
+        vectorized from a FeatureStore.
+        """
+        counts = None
         try:
-            words = list(words.words)
+            counts = words.counts
+            words = words.words
         except AttributeError:
+            pass
+        words = self._configure_pool(words, counts, seen)
+        if cascade is not None:
+            (proxy, size) = cascade
+            (words, counts) = self._prefilter(
+                proxy, size, words, counts, seen, generic)
+        if getattr(self.scorer, 'prefix_sharing', False):
+            # words sharing prefixes end up in the same chunks
+            (words, counts) = _sorted_pool(words, counts)
+        features = self.calculate_features(words, generic)
+        if self.columnar and hasattr(self.metric, 'score_columns'):
+            from morphsegannot.tools.featurestore import FeatureStore
+            store = FeatureStore.from_features(features)
+            (scores, valid) = self.metric.score_columns(store)
+            return store.top(scores, valid, top, self.metric.descending)
+        if counts is not None:
+            features = _with_frequency(features, counts)
+        if top is not None and not self.metric.greedy:
+            return self.metric.top(features, top)
+        scored = self.metric.rank(list(features), n)
+        if top is not None:
+            scored = scored[:top]
+        return scored
+
+    def _configure_pool(self, words, counts, seen):
+        """Configures the metric on the pool, unless already configured"""
+        if not self.metric.configured and hasattr(self.metric, 'configure'):
             words = list(words)
-        try:
-            if not self.metric.configured:
-                self.metric.configure(words, seen, self.model)
+            if counts is not None:
+                # configured on tokens, as with the full pool
+                config_words = _expand(words, counts)
+            else:
+                config_words = words
+            try:
+                self.metric.configure(config_words, seen, self.model)
                 print('Used training pool to configure')
-        except AttributeError:
+            except AttributeError:
+                pass
+        return words
+
+    def _prefilter(self, proxy, size, words, counts, seen, generic):
+        """The size best words according to the proxy metric,
+        in pool order, with their counts"""
+        stage = Selector(proxy, self.model, progress=self._progress,
+                         workers=self.workers, chunksize=self.chunksize,
+                         cache=self.cache, scorer=self.scorer)
+        words = list(stage._configure_pool(words, counts, seen))
+        best = set(sw.word for sw in proxy.top(
+            stage.calculate_features(words, generic), size))
+        kept = [i for i in range(len(words)) if words[i] in best]
+        if counts is not None:
+            counts = [counts[i] for i in kept]
+        return ([words[i] for i in kept], counts)
+
+
+def generic_features(model, metrics, words, **kwargs):
+    """Calculates in a single pass the model features
+    needed by any of the metrics.
+
+    Returns a dict from word to generic features,
+    to be shared by the metrics through Selector.rank.
+    Keyword arguments are passed on to the Selector.
+    """
+    need = _GenericMetric(
+        max(metric.need_nbest for metric in metrics),
+        any(metric.need_forward for metric in metrics))
+    selector = Selector(need, model, **kwargs)
+    return {wfeature.word: wfeature.f['generic']
+            for wfeature in selector.calculate_features(words)}
+
+
+# Selector used by the worker processes of Selector.calculate_features
+_worker_selector = None
+
+
+def _worker_features(chunk):
+    return _worker_selector._chunk_features(chunk)
+
+
+class _SubstringWeights(object):
+    """Weights of substrings for IFSubstringMetric.
+
+    Counts are optionally normalized by the average count
+    of the substrings of the same length.
+    The normalization is applied on access,
+    so that the counts can be updated without renormalizing everything.
+    Zeroed (seen) substrings have weight 0.
+    """
+    def __init__(self, counts, normalize):
+        self.counts = counts
+        self.normalize = normalize
+        self.zeroed = set()
+        self.sum_by_len = collections.Counter()
+        self.count_by_len = collections.Counter()
+        for (sub, count) in counts.items():
+            self.sum_by_len[len(sub)] += count
+            self.count_by_len[len(sub)] += 1
+        self._normalized = {}
+
+    def __getitem__(self, sub):
+        if sub in self.zeroed:
+            return 0
+        count = self.counts.get(sub, 0)
+        if not self.normalize or count == 0:
+            return count
+        try:
+            return self._normalized[sub]
+        except KeyError:
             pass
-        features = list(self.calculate_features(words))
-        scored = self.metric.rank(features, n)
-        return scored
+        weight = count / float(self.sum_by_len[len(sub)])
+        weight *= float(self.count_by_len[len(sub)])
+        self._normalized[sub] = weight
+        return weight
+
+    def update(self, counts, sign):
+        for (sub, count) in counts.items():
+            old = self.counts.get(sub, 0)
+            new = old + sign * count
+            if new < 0:
+                raise Exception(
+                    'Removing unseen substring "{}"'.format(sub))
+            if old == 0 and new > 0:
+                self.count_by_len[len(sub)] += 1
+            elif old > 0 and new == 0:
+                self.count_by_len[len(sub)] -= 1
+            self.sum_by_len[len(sub)] += new - old
+            if new == 0:
+                self.counts.pop(sub, None)
+            else:
+                self.counts[sub] = new
+        # every weight of an affected length may have changed
+        self._normalized = {}
+
+
+# IFSubstringMetric used by the worker processes of configure
+_worker_metric = None
+
+
+def _worker_counts(words):
+    return _worker_metric._count(words)
+
+
+def _fork_pool(workers):
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        # python 2 always forks
+        context = multiprocessing
+    return context.Pool(workers)
+
+
+def _bounded_map(pool, func, iterable, window):
+    """Applies func in the pool, yielding (item, result) pairs
+    in the original order. At most window items are in flight,
+    so the iterable is consumed only as fast as results are used."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append((item, pool.apply_async(func, (item,))))
+        if len(pending) > window:
+            (item, result) = pending.popleft()
+            yield (item, result.get())
+    while len(pending) > 0:
+        (item, result) = pending.popleft()
+        yield (item, result.get())
+
+
+def _expand(words, counts):
+    for (word, count) in zip(words, counts):
+        for _ in range(count):
+            yield word
+
+
+def _sorted_pool(words, counts):
+    """Sorts the words, keeping the counts aligned"""
+    if counts is None:
+        return (sorted(words), None)
+    words = list(words)
+    order = sorted(range(len(words)), key=words.__getitem__)
+    return ([words[i] for i in order], [counts[i] for i in order])
+
+
+def _with_frequency(features, counts):
+    counts = iter(counts)
+    for wfeature in features:
+        wfeature.f['frequency'] = next(counts)
+        yield wfeature
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
 
 class AbstractMetric(object):
@@ -73,6 +448,15 @@ class AbstractMetric(object):
     need_forward = False
     descending = False
     configured = False
+    # greedy metrics need all candidates in memory while ranking
+    greedy = False
+    # processes available for configuring (set by Selector)
+    workers = 1
+    # Optional prefilter(word, generic) on the generic features
+    # without the forward cost. For words it rejects,
+    # score() must not need the forward cost (or uncertainty),
+    # which is then not computed.
+    prefilter = None
 
     @staticmethod
     def features(word, features):
@@ -86,6 +470,23 @@ class AbstractMetric(object):
         scored = sorted(scored, reverse=self.descending)
         return scored
 
+    def top(self, features, k):
+        """The k first words of rank(),
+        without keeping the rest in memory."""
+        scored = self.score(features)
+        if self.descending:
+            return heapq.nlargest(k, scored)
+        return heapq.nsmallest(k, scored)
+
+
+class _GenericMetric(AbstractMetric):
+    """Placeholder metric only requesting generic features"""
+    name = 'generic'
+
+    def __init__(self, need_nbest, need_forward):
+        self.need_nbest = need_nbest
+        self.need_forward = need_forward
+
 
 class UncertaintyMetric(AbstractMetric):
     """Chooses words based on
@@ -103,6 +504,10 @@ class UncertaintyMetric(AbstractMetric):
             yield ScoredWord(wfeature.f[self.name],
                              wfeature.word)
 
+    @classmethod
+    def score_columns(self, store):
+        return (store.uncertainty, None)
+
 
 class MarginMetric(AbstractMetric):
     """Chooses words based on
@@ -144,8 +549,54 @@ class LogpMetric(AbstractMetric):
             yield ScoredWord(logp / len(wfeature.word),
                              wfeature.word)
 
+    @classmethod
+    def score_columns(self, store):
+        return (store.viterbi_logp / store.lengths, None)
+
+
+class AbstractGreedyMetric(AbstractMetric):
+    """Metric selecting one word at a time,
+    with the scores of the rest depending on what has been selected.
 
-class IFSubstringMetric(AbstractMetric):
+    Subclasses implement _start(features), setting self._words
+    and self._queue (a _GreedyQueue), and _select(i),
+    returning (position, new score) for the words affected
+    by selecting the word in position i.
+    The ranking state can be saved and later extended.
+    """
+    greedy = True
+
+    def rank(self, features, n):
+        assert n is not None, '{} requires n'.format(type(self).__name__)
+        self._start(features)
+        return self.extend(n)
+
+    def extend(self, k):
+        """Continues the ranking by selecting k more words"""
+        scored = []
+        while len(scored) < k and len(self._queue) > 0:
+            (i, score) = self._queue.pop()
+            scored.append(ScoredWord(score, self._words[i]))
+            for (j, score) in self._select(i):
+                self._queue.update(j, score)
+        return scored
+
+    def save_ranking(self, filename):
+        """Saves the state of the ranking, for extending it later"""
+        with open(filename, 'wb') as fobj:
+            pickle.dump((self.name, self.__dict__), fobj, 2)
+
+    def load_ranking(self, filename):
+        with open(filename, 'rb') as fobj:
+            (name, state) = pickle.load(fobj)
+        if name != self.name:
+            raise Exception(
+                'Ranking state "{}" is for metric {}, not {}'.format(
+                    filename, name, self.name))
+        self.__dict__.update(state)
+
+
+class IFSubstringMetric(AbstractGreedyMetric):
     """Chooses words based on
     maximizing the coverage of initial and final substrings.
     Already seen substrings are not rewarded.
@@ -154,12 +605,16 @@ class IFSubstringMetric(AbstractMetric):
     need_forward = False
     descending = True
 
-    def __init__(self, normalize=True, namesuffix='std', maxlen=5):
+    def __init__(self, normalize=True, namesuffix='std', maxlen=5,
+                 vectorized=False):
         self.name = 'ifsubstrings_{}'.format(namesuffix)
         self.normalize = normalize
+        # use the numpy sparse matrix backend for ranking
+        self.vectorized = vectorized
 
         self.i_substrings = None
         self.f_substrings = None
+        self.seen = set()
 
         self.minlen = 2
         self.maxlen = maxlen
@@ -171,38 +626,110 @@ class IFSubstringMetric(AbstractMetric):
 
     def configure(self, words, seen, model=None):
         # FIXME: should we be counting substrs from unannotated corpus?
-        self.i_substrings = collections.Counter()
-        self.f_substrings = collections.Counter()
+        if self.workers > 1:
+            i_counts = collections.Counter()
+            f_counts = collections.Counter()
+            for (i_chunk, f_chunk) in self._parallel_counts(words):
+                i_counts.update(i_chunk)
+                f_counts.update(f_chunk)
+        else:
+            (i_counts, f_counts) = self._count(words)
+        self.i_substrings = _SubstringWeights(i_counts, self.normalize)
+        self.f_substrings = _SubstringWeights(f_counts, self.normalize)
+        self._zero_seen(seen)
+        self.configured = True
+
+    def update(self, seen, added=None, removed=None):
+        """Updates the configuration incrementally.
+
+        added and removed are Counters of the words
+        that have been added to or removed from the configuring corpus
+        since the metric was configured (or its state was saved).
+        seen are all the currently seen words.
+        """
+        for (words, sign) in ((added, 1), (removed, -1)):
+            if not words:
+                continue
+            (i_counts, f_counts) = self._count(words.elements())
+            self.i_substrings.update(i_counts, sign)
+            self.f_substrings.update(f_counts, sign)
+        self._zero_seen(seen)
+        self.configured = True
+
+    def _zero_seen(self, seen):
+        # zeroing seen substrings (could add malus also)
+        self.seen = set()
+        self.i_substrings.zeroed = set()
+        self.f_substrings.zeroed = set()
+        if seen is None:
+            return
+        for word in seen:
+            self.seen.add(word)
+            (initial, final) = self._substrings(word)
+            self.i_substrings.zeroed.update(initial)
+            self.f_substrings.zeroed.update(final)
+
+    def save_state(self, filename, corpus=None):
+        """Saves the substring counts and the seen words,
+        so that the next iteration can update them incrementally.
+        corpus optionally describes what the metric was configured on,
+        for finding out what has changed."""
+        state = {'normalize': self.normalize,
+                 'minlen': self.minlen,
+                 'maxlen': self.maxlen,
+                 'i_counts': self.i_substrings.counts,
+                 'f_counts': self.f_substrings.counts,
+                 'seen': self.seen,
+                 'corpus': corpus}
+        with open(filename, 'wb') as fobj:
+            pickle.dump(state, fobj, 2)
+
+    def load_state(self, filename):
+        """Loads a state saved by save_state.
+        Returns the corpus description saved with it.
+        The metric must still be updated with the current seen words."""
+        with open(filename, 'rb') as fobj:
+            state = pickle.load(fobj)
+        for key in ('normalize', 'minlen', 'maxlen'):
+            if state[key] != getattr(self, key):
+                raise Exception(
+                    'Metric state "{}" has {} {}, not {}'.format(
+                        filename, key, state[key], getattr(self, key)))
+        self.i_substrings = _SubstringWeights(
+            state['i_counts'], self.normalize)
+        self.f_substrings = _SubstringWeights(
+            state['f_counts'], self.normalize)
+        self._zero_seen(state['seen'])
+        return state['corpus']
+
+    def _parallel_counts(self, words, chunksize=50000):
+        """Counts substrings in chunks of the (streamed) words,
+        yielding the Counters of each chunk"""
+        # the workers inherit the metric through fork
+        global _worker_metric
+        _worker_metric = self
+        pool = _fork_pool(self.workers)
+        try:
+            for (_, counts) in _bounded_map(
+                    pool, _worker_counts, _chunks(words, chunksize),
+                    2 * self.workers):
+                yield counts
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _worker_metric = None
+
+    def _count(self, words):
+        i_counts = collections.Counter()
+        f_counts = collections.Counter()
         for word in words:
             (initial, final) = self._substrings(word)
             for sub in initial:
-                self.i_substrings[sub] += 1
+                i_counts[sub] += 1
             for sub in final:
-                self.f_substrings[sub] += 1
-        if self.normalize:
-            self._normalize(self.i_substrings)
-            self._normalize(self.f_substrings)
-        # zeroing seen substrings (could add malus also)
-        if seen is not None:
-            for word in seen:
-                (initial, final) = self._substrings(word)
-                for sub in initial:
-                    self.i_substrings[sub] = 0
-                for sub in final:
-                    self.f_substrings[sub] = 0
-        self.configured = True
-
-    @staticmethod
-    def _normalize(substrings):
-        # normalize by average count for substring length
-        sum_by_len = collections.Counter()
-        count_by_len = collections.Counter()
-        for (sub, count) in substrings.items():
-            sum_by_len[len(sub)] += count
-            count_by_len[len(sub)] += 1
-        for sub in substrings.keys():
-            substrings[sub] /= float(sum_by_len[len(sub)])
-            substrings[sub] *= float(count_by_len[len(sub)])
+                f_counts[sub] += 1
+        return (i_counts, f_counts)
 
     def _substrings(self, word):
         initial = []
@@ -220,41 +747,88 @@ class IFSubstringMetric(AbstractMetric):
 
     def score(self, wfeatures):
         for wfeature in wfeatures:
-            i_score = 0
-            f_score = 0
-            (initial, final) = self._substrings(wfeature.word)
-            for sub in initial:
-                if sub not in self.i_mask:
-                    i_score += self.i_substrings[sub]
-            for sub in final:
-                if sub not in self.f_mask:
-                    f_score += self.f_substrings[sub]
-            yield ScoredWord(i_score + f_score,
+            yield ScoredWord(self._word_score(wfeature.word),
                              wfeature.word)
 
-    def rank(self, words, n):
-        assert n is not None, 'IFSubstringMetric requires n'
-        scored = []
+    def _word_score(self, word):
+        i_score = 0
+        f_score = 0
+        (initial, final) = self._substrings(word)
+        for sub in initial:
+            if sub not in self.i_mask:
+                i_score += self.i_substrings[sub]
+        for sub in final:
+            if sub not in self.f_mask:
+                f_score += self.f_substrings[sub]
+        return i_score + f_score
+
+    def _start(self, words):
+        # Only words sharing a substring with the selected word
+        # change score, so only those are rescored.
         self.i_mask = set()
         self.f_mask = set()
-        while len(scored) < n and len(words) > 0:
-            (best, words) = self._select_best(words)
-            scored.append(best)
-        return scored
-
-    def _select_best(self, words):
-        scored = self.score(words)
-        scored = sorted(scored, reverse=self.descending)
-        selected = scored.pop(0)
-        (initial, final) = self._substrings(selected.word)
+        self._words = [wf.word for wf in words]
+        if self.vectorized:
+            from morphsegannot.tools.substringmatrix import SubstringMatrix
+            self._coverage = SubstringMatrix(self._words, self)
+        else:
+            self._coverage = _SubstringIndex(self._words, self)
+        self._queue = _GreedyQueue(self._coverage.scores(), self._words)
+
+    def load_ranking(self, filename):
+        super(IFSubstringMetric, self).load_ranking(filename)
+        if not self.vectorized:
+            # the index refers to the metric that was saved
+            self._coverage.metric = self
+
+    def _select(self, i):
+        affected = self._coverage.mask(i)
+        (initial, final) = self._substrings(self._words[i])
+        self.i_mask.update(initial)
+        self.f_mask.update(final)
+        return zip(affected, self._coverage.scores(affected))
+
+
+class _SubstringIndex(object):
+    """Inverted indices from initial and final substrings
+    to the positions of the words containing them.
+
+    Affected words are rescored from their substrings
+    (instead of subtracting the masked weight),
+    to keep the scores identical to IFSubstringMetric.score().
+    """
+    def __init__(self, words, metric):
+        self.words = words
+        self.metric = metric
+        self.i_index = collections.defaultdict(list)
+        self.f_index = collections.defaultdict(list)
+        for (i, word) in enumerate(words):
+            (initial, final) = metric._substrings(word)
+            for sub in initial:
+                self.i_index[sub].append(i)
+            for sub in final:
+                self.f_index[sub].append(i)
+
+    def scores(self, rows=None):
+        if rows is None:
+            rows = range(len(self.words))
+        return [self.metric._word_score(self.words[i]) for i in rows]
+
+    def mask(self, row):
+        """Returns the positions of the words
+        affected by masking the substrings of the word in row."""
+        affected = set()
+        (initial, final) = self.metric._substrings(self.words[row])
         for sub in initial:
-            self.i_mask.add(sub)
+            if sub not in self.metric.i_mask:
+                affected.update(self.i_index[sub])
         for sub in final:
-            self.f_mask.add(sub)
-        return (selected, scored)
+            if sub not in self.metric.f_mask:
+                affected.update(self.f_index[sub])
+        return list(affected)
 
 
-class OneOffBoundaryMetric(AbstractMetric):
+class OneOffBoundaryMetric(AbstractGreedyMetric):
     """Chooses words based on
     morphs x = yc or cy,
     weighted by frequency, with uncertainty as tiebreaker.
@@ -311,34 +885,43 @@ class OneOffBoundaryMetric(AbstractMetric):
 
     def score(self, wfeatures):
         for wfeature in wfeatures:
-            score = 0
-            for cmorph in wfeature.f['generic']['viterbi'][0][0]:
-                morph = cmorph.morph
-                if morph not in self.mask:
-                    score += self.weights[morph]
             assert 'uncertainty' in wfeature.f
-            yield ScoredWord((score, wfeature.f['uncertainty']),
+            yield ScoredWord((self._morph_score(wfeature),
+                              wfeature.f['uncertainty']),
                              wfeature)
 
-    def rank(self, words, n):
-        assert n is not None, 'OneOffBoundaryMetric requires n'
-        scored = []
+    def _morph_score(self, wfeature):
+        score = 0
+        for cmorph in wfeature.f['generic']['viterbi'][0][0]:
+            morph = cmorph.morph
+            if morph not in self.mask:
+                score += self.weights[morph]
+        return score
+
+    def _start(self, words):
+        # Only words whose analysis contains a newly masked morph
+        # change score, so those are found through an inverted index.
         self.mask = set()
-        while len(scored) < n and len(words) > 0:
-            (best, words) = self._select_best(words)
-            scored.append(ScoredWord(
-                best.score,
-                best.word.word))
-        return scored
+        self._features = list(words)
+        self._words = [wfeature.word for wfeature in self._features]
+        self._index = collections.defaultdict(list)
+        for (i, wfeature) in enumerate(self._features):
+            for cmorph in wfeature.f['generic']['viterbi'][0][0]:
+                self._index[cmorph.morph].append(i)
+        self._queue = _GreedyQueue(
+            [sw.score for sw in self.score(self._features)], self._words)
 
-    def _select_best(self, words):
-        scored = self.score(words)
-        scored = sorted(scored, reverse=self.descending)
-        selected = scored.pop(0)
-        for cmorph in selected.word.f['generic']['viterbi'][0][0]:
+    def _select(self, i):
+        affected = set()
+        for cmorph in self._features[i].f['generic']['viterbi'][0][0]:
             morph = cmorph.morph
-            self.mask.add(morph)
-        return (selected, [x.word for x in scored])
+            if morph not in self.mask:
+                self.mask.add(morph)
+                affected.update(self._index[morph])
+        for j in affected:
+            wfeature = self._features[j]
+            yield (j, (self._morph_score(wfeature),
+                       wfeature.f['uncertainty']))
 
 
 class MorphLogpMetric(AbstractMetric):
@@ -435,6 +1018,9 @@ class CategoryMetric(AbstractMetric):
     need_forward = True     # needed by uncertainty
     descending = True
 
+    def prefilter(self, word, generic):
+        return self.features(word, {'generic': generic})
+
     def features(self, word, features):
         analysis = features['generic']['viterbi'][0][0]
         categories = [cmorph.category for cmorph in analysis]
@@ -456,6 +1042,9 @@ class CategoryMetric(AbstractMetric):
             yield ScoredWord(wfeature.f['uncertainty'],
                              wfeature.word)
 
+    def score_columns(self, store):
+        return (store.uncertainty, store.has_pair(('STM', 'ZZZ')))
+
 
 class NoStmMetric(AbstractMetric):
     """Chooses words based on
@@ -467,6 +1056,9 @@ class NoStmMetric(AbstractMetric):
     need_forward = True     # needed by uncertainty
     descending = True
 
+    def prefilter(self, word, generic):
+        return not self.features(word, {'generic': generic})
+
     def features(self, word, features):
         analysis = features['generic']['viterbi'][0][0]
         categories = [cmorph.category for cmorph in analysis]
@@ -481,10 +1073,64 @@ class NoStmMetric(AbstractMetric):
             yield ScoredWord(wfeature.f['uncertainty'],
                              wfeature.word)
 
+    def score_columns(self, store):
+        return (store.uncertainty, ~store.has_category(('STM',)))
+
+
+class _GreedyQueue(object):
+    """Max-heap of candidate positions keyed by their cached score.
+
+    Changed scores are pushed as new entries,
+    superseded entries are discarded when they surface.
+    Ties are broken by descending word, like sorted(..., reverse=True).
+    """
+    def __init__(self, scores, words):
+        self.scores = list(scores)
+        self._tiebreak = _descending_order(words)
+        self._done = [False] * len(self.scores)
+        self._left = len(self.scores)
+        self._heap = [(_negate(score), self._tiebreak[i], i)
+                      for (i, score) in enumerate(self.scores)]
+        heapq.heapify(self._heap)
+
+    def update(self, i, score):
+        if self._done[i] or score == self.scores[i]:
+            return
+        self.scores[i] = score
+        heapq.heappush(self._heap, (_negate(score), self._tiebreak[i], i))
+
+    def pop(self):
+        while True:
+            (negscore, _, i) = heapq.heappop(self._heap)
+            if self._done[i] or negscore != _negate(self.scores[i]):
+                continue
+            self._done[i] = True
+            self._left -= 1
+            return (i, self.scores[i])
 
-def write_scores(ranked, filename):
+    def __len__(self):
+        return self._left
+
+
+def _negate(score):
+    if isinstance(score, tuple):
+        return tuple(-x for x in score)
+    return -score
+
+
+def _descending_order(words):
+    """Rank of each word in descending order,
+    for breaking score ties like sorted(..., reverse=True) does."""
+    order = sorted(range(len(words)), key=lambda i: words[i], reverse=True)
+    ranks = [0] * len(words)
+    for (rank, i) in enumerate(order):
+        ranks[i] = rank
+    return ranks
+
+
+def write_scores(ranked, filename, mode='w'):
     """Debug function to write all scores out into file"""
-    with codecs.open(filename, 'w', encoding='utf-8') as fobj:
+    with codecs.open(filename, mode, encoding='utf-8') as fobj:
         for score in ranked:
             fobj.write('{}\t{}\n'.format(score.word, score.score))
 
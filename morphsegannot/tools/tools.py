@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import array
 import codecs
 import collections
 import hashlib
@@ -15,7 +16,9 @@ import flatcat
 # I meant to rewrite as a saner version, but never got to it
 
 Context = collections.namedtuple('Context', ['left', 'word', 'right'])
-Pool = collections.namedtuple('Pool', ['id', 'metric', 'words'])
+Pool = collections.namedtuple('Pool', ['id', 'metric', 'words', 'counts'])
+# counts (frequencies of the words) are only given for compact pools
+Pool.__new__.__defaults__ = (None,)
 Annotation = collections.namedtuple('Annotation', ['word', 'analysis'])
 GroupedAnnotation = collections.namedtuple('GroupedAnnotation',
     ['type', 'id', 'metric', 'word', 'analysis'])
@@ -34,13 +37,19 @@ def get_contexts(words, corpusfile):
 
 def get_pools(pools,
               pooldir,
-              suffix='pool.words'):
-    """Gets words in (static) pools"""
+              suffix='pool.words',
+              compact=False):
+    """Gets words in (static) pools.
+    Compact pools contain each word type once, with its frequency."""
     for pool in pools:
         filepath = os.path.join(
             pooldir,
             '{}{}'.format(pool, suffix))
-        yield Pool(pool, None, read_wordlist(filepath))
+        if compact:
+            (words, counts) = compact_wordlist(read_wordlist(filepath))
+            yield Pool(pool, None, words, counts)
+        else:
+            yield Pool(pool, None, read_wordlist(filepath))
 
 
 def get_selections(metrics,
@@ -78,6 +87,15 @@ def filter_pool(pool, seen):
     # use for removing already selected words before selection
     # and for removing old annots after selection
     key = (pool.id, pool.metric)
+    if pool.counts is not None:
+        kept = [(word, count)
+                for (word, count) in zip(pool.words, pool.counts)
+                if word not in seen]
+        return Pool(pool.id,
+                    pool.metric,
+                    [word for (word, _) in kept],
+                    array.array(pool.counts.typecode,
+                                [count for (_, count) in kept]))
     return Pool(pool.id,
                 pool.metric,
                 [word for word in pool.words
@@ -107,9 +125,26 @@ def read_wordlist(word_file, firstcol=True):
                 line = parts[0].strip()
             yield line
 
+def compact_wordlist(words):
+    """Unique word types (in order of first occurrence)
+    and an array of their frequencies, in one pass."""
+    index = {}
+    types = []
+    counts = array.array(str('l'))
+    for word in words:
+        i = index.get(word, None)
+        if i is None:
+            index[word] = len(types)
+            types.append(word)
+            counts.append(1)
+        else:
+            counts[i] += 1
+    return (types, counts)
+
 def pool_progress(pool):
     return Pool(pool.id, pool.metric,
-                 flatcat.utils._generator_progress(pool.words))
+                 flatcat.utils._generator_progress(pool.words),
+                 pool.counts)
 
 # Helpers for contexts
 
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+
+import argparse
+import random
+import sys
+import time
+
+import flatcat
+from morphsegannot.tools import tools, selection
+
+METRICS = {
+    'uncertainty': selection.UncertaintyMetric,
+    'margin': selection.MarginMetric,
+    'morphlogp_min':
+        lambda: selection.MorphLogpMetric(func=min, namesuffix='min'),
+    }
+
+PROXIES = {
+    'logp': selection.LogpMetric,
+    'ifsubstrings':
+        lambda: selection.IFSubstringMetric(normalize=True, namesuffix='norm', maxlen=4),
+    }
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        prog='benchmark_cascade.py',
+        description='Measures the recall of cascade ranking '
+                    '(select_for_elicitation.py --cascade) '
+                    'against a full ranking, on a sample of a pool.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False)
+    add_arg = parser.add_argument
+
+    add_arg('model', metavar='<model>',
+            help='Flatcat model tarball')
+    add_arg('pool', metavar='<wordlist>',
+            help='Pool of words, one per line (first column)')
+
+    add_arg('--metric', dest='metric', default='uncertainty',
+            choices=sorted(METRICS.keys()),
+            help='Selection metric. (default: %(default)s)')
+    add_arg('--proxy', dest='proxy', default='logp',
+            choices=sorted(PROXIES.keys()),
+            help='Proxy metric of the cascade. (default: %(default)s)')
+    add_arg('--factors', dest='factors', type=int, nargs='+',
+            metavar='<int>', default=[2, 5, 10, 20],
+            help='Values of M to try. (default: %(default)s)')
+    add_arg('--sample', dest='sample', type=int,
+        metavar='<int>', default=10000,
+        help='Number of pool words to sample. '
+             '(default: %(default)s)')
+    add_arg('-n', dest='num_annots', type=int,
+        metavar='<int>', default=50,
+        help='Number of words to select. '
+             '(default: %(default)s)')
+    add_arg('--seed', dest='seed', type=int,
+        metavar='<int>', default=1,
+        help='Seed for sampling the pool. (default: %(default)s)')
+
+    add_arg('-h', '--help', action='help',
+            help="show this help message and exit")
+    return parser
+
+
+def timed_rank(model, words, n, cascade=None, metric='uncertainty'):
+    selector = selection.Selector(METRICS[metric](), model)
+    start = time.time()
+    ranked = selector.rank(words, n=n, top=n, cascade=cascade)
+    return (set(sw.word for sw in ranked), time.time() - start)
+
+
+def main(argv):
+    parser = get_argparser()
+    args = parser.parse_args(argv)
+
+    io = flatcat.FlatcatIO(encoding='utf-8')
+    print('Loading model...')
+    model = io.read_tarball_model_file(args.model)
+    model.initialize_hmm()
+    print('...done')
+
+    words = sorted(set(line.split('\t', 1)[0]
+                       for line in tools.read_wordlist(args.pool)))
+    if len(words) > args.sample:
+        words = random.Random(args.seed).sample(words, args.sample)
+
+    (full, full_time) = timed_rank(
+        model, words, args.num_annots, metric=args.metric)
+    print('full: {} words in {:.1f}s'.format(len(words), full_time))
+    for factor in args.factors:
+        cascade = (PROXIES[args.proxy](), factor * args.num_annots)
+        (ranked, cascade_time) = timed_rank(
+            model, words, args.num_annots, cascade, args.metric)
+        recall = len(ranked & full) / float(max(len(full), 1))
+        print('M={}: recall {:.3f}, {:.1f}s ({:.1f}x faster)'.format(
+            factor, recall, cascade_time,
+            full_time / max(cascade_time, 1e-9)))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
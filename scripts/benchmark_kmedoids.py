@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+
+import argparse
+import sys
+import time
+
+from morphsegannot.tools import representative
+from morphsegannot.tools import tools
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        prog='benchmark_kmedoids.py',
+        description='Compares the speed and clustering cost '
+                    '(sum of squared distances to the medoids) '
+                    'of the representative sampling algorithms.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False)
+    add_arg = parser.add_argument
+
+    add_arg('infile', metavar='<infile>',
+            help='File containing pre-ranked words')
+
+    add_arg('--truncate', dest='num_input', type=int,
+        metavar='<int>', default=500,
+        help='Number of words of input to read. '
+                '(default: %(default)s)')
+    add_arg('-n', dest='num_annots', type=int,
+        metavar='<int>', default=50,
+        help='Number of words to select. '
+             '(default: %(default)s)')
+    add_arg('--algorithms', dest='algorithms', nargs='+',
+        default=list(representative.ALGORITHMS),
+        choices=representative.ALGORITHMS,
+        help='Algorithms to compare. (default: all)')
+    add_arg('--seed', dest='seed', type=int,
+        metavar='<int>', default=1,
+        help='Random seed. (default: %(default)s)')
+    add_arg('--workers', dest='workers', type=int,
+        metavar='<int>', default=1,
+        help='Number of processes for computing the distances '
+             'and the voronoi restarts. '
+             '(default: %(default)s)')
+
+    add_arg('-h', '--help', action='help',
+            help="show this help message and exit")
+    return parser
+
+
+def main(argv):
+    parser = get_argparser()
+    args = parser.parse_args(argv)
+
+    words = []
+    for line in tools.read_wordlist(args.infile):
+        words.append(line.split('\t', 1)[0])
+        if len(words) >= args.num_input:
+            break
+
+    start = time.time()
+    dist = representative.distances(words, workers=args.workers)
+    print('distances: {} words in {:.1f}s'.format(
+        len(words), time.time() - start))
+    for algorithm in args.algorithms:
+        start = time.time()
+        if algorithm == 'bktree':
+            medoids = representative.bktree_medoids(words, args.num_annots)
+        elif algorithm == 'clara':
+            # computes its own distances, but not the whole matrix
+            medoids = representative.clara(
+                words, args.num_annots, seed=args.seed)
+        else:
+            medoids, _ = representative.kmedoids(
+                dist, args.num_annots, algorithm, args.seed, args.workers)
+        print('{}: cost {} in {:.2f}s'.format(
+            algorithm, representative.total_cost(dist, medoids),
+            time.time() - start))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
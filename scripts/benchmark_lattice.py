@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+
+import argparse
+import sys
+import time
+
+import flatcat
+from morphsegannot.tools import tools, lattice, batchlattice
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        prog='benchmark_lattice.py',
+        description='Checks the lattice scorers against the model, '
+                    'and measures their throughput in words/sec.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False)
+    add_arg = parser.add_argument
+
+    add_arg('model', metavar='<model>',
+            help='Flatcat model tarball')
+    add_arg('wordlist', metavar='<wordlist>',
+            help='Words to score, one per line (first column)')
+
+    add_arg('--truncate', dest='num_words', type=int,
+        metavar='<int>', default=10000,
+        help='Number of words to read. '
+             '(default: %(default)s)')
+    add_arg('--check', dest='num_check', type=int,
+        metavar='<int>', default=200,
+        help='Number of words to check against the model. '
+             '(default: %(default)s)')
+    add_arg('--chunksize', dest='chunksize', type=int,
+        metavar='<int>', default=500,
+        help='Number of words per batch. '
+             '(default: %(default)s)')
+    add_arg('--skip-model', dest='skipmodel', default=False,
+            action='store_true',
+            help='Do not time the model itself (it is slow).')
+
+    add_arg('-h', '--help', action='help',
+            help="show this help message and exit")
+    return parser
+
+
+def model_engine(model):
+    def analyze(words):
+        return [([model.viterbi_analyze(word)], model.forward_logprob(word))
+                for word in words]
+    return analyze
+
+
+def scorer_engine(scorer):
+    def analyze(words):
+        return [scorer.analyze(word, 1, True) for word in words]
+    return analyze
+
+
+def batch_engine(scorer):
+    def analyze(words):
+        return scorer.analyze_batch(words, 1, True)
+    return analyze
+
+
+def throughput(analyze, words, chunksize):
+    start = time.time()
+    for i in range(0, len(words), chunksize):
+        analyze(words[i:i + chunksize])
+    return len(words) / max(time.time() - start, 1e-9)
+
+
+def main(argv):
+    parser = get_argparser()
+    args = parser.parse_args(argv)
+
+    io = flatcat.FlatcatIO(encoding='utf-8')
+    print('Loading model...')
+    model = io.read_tarball_model_file(args.model)
+    model.initialize_hmm()
+    print('...done')
+
+    words = []
+    for line in tools.read_wordlist(args.wordlist):
+        words.append(line.split('\t', 1)[0])
+        if len(words) >= args.num_words:
+            break
+    # as selection does for the prefix sharing scorer
+    words.sort()
+
+    engines = [
+        ('lattice', lattice.LatticeScorer(model)),
+        ('batch', batchlattice.BatchLatticeScorer(model)),
+        ('prefix', lattice.PrefixLatticeScorer(model))]
+    for (name, scorer) in engines:
+        agrees = scorer.agrees(model, words[:args.num_check])
+        print('{}: {} the model on {} words'.format(
+            name, 'agrees with' if agrees else 'DISAGREES with',
+            min(args.num_check, len(words))))
+
+    timed = [
+        ('lattice', scorer_engine(engines[0][1])),
+        ('batch', batch_engine(engines[1][1])),
+        ('prefix', batch_engine(engines[2][1]))]
+    if not args.skipmodel:
+        timed.insert(0, ('model', model_engine(model)))
+    for (name, analyze) in timed:
+        print('{}: {:.1f} words/sec'.format(
+            name, throughput(analyze, words, args.chunksize)))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
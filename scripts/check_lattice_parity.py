@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+
+import argparse
+import itertools
+import math
+import random
+import sys
+
+import flatcat
+from morphsegannot.tools import lattice, batchlattice
+from morphsegannot.tools.selection import LOGPROB_ZERO
+
+CATEGORIES = ['PRE', 'STM', 'SUF', 'ZZZ']
+WB = '#'
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        prog='check_lattice_parity.py',
+        description='Checks the lattice scorers against a brute-force '
+                    'enumeration of the analyses, on a random stub model. '
+                    'Needs no model tarball.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False)
+    add_arg = parser.add_argument
+
+    add_arg('--words', dest='num_words', type=int,
+        metavar='<int>', default=100,
+        help='Number of random words to check. '
+             '(default: %(default)s)')
+    add_arg('--maxlen', dest='maxlen', type=int,
+        metavar='<int>', default=6,
+        help='Maximum word length. The enumeration is exponential '
+             'in it. (default: %(default)s)')
+    add_arg('--nbest', dest='nbest', type=int,
+        metavar='<int>', default=3,
+        help='Depth of the n-best lists to check. '
+             '(default: %(default)s)')
+    add_arg('--seed', dest='seed', type=int,
+        metavar='<int>', default=1,
+        help='Random seed. (default: %(default)s)')
+
+    add_arg('-h', '--help', action='help',
+            help="show this help message and exit")
+    return parser
+
+
+class StubCoding(object):
+    """Random transition and emission costs"""
+    def __init__(self, rand, lexicon):
+        labels = CATEGORIES + [WB]
+        self.transitions = dict(
+            ((prev, nxt), rand.uniform(0.1, 3.0))
+            for prev in labels for nxt in labels)
+        self.emissions = dict(
+            ((cat, morph), rand.uniform(0.5, 8.0))
+            for morph in lexicon for cat in CATEGORIES)
+
+    def log_transitionprob(self, prev, nxt):
+        return self.transitions[(prev, nxt)]
+
+    def log_emissionprob(self, cat, morph):
+        return self.emissions[(cat, morph)]
+
+
+class StubModel(object):
+    """The parts of a flatcat model read by the lattice scorers,
+    with the analyses found by enumerating every segmentation
+    and categorization of the word."""
+    def __init__(self, rand, alphabet, size=60):
+        # every character is in the lexicon,
+        # keeping the costs far from LOGPROB_ZERO
+        lexicon = set(alphabet)
+        while len(lexicon) < size:
+            lexicon.add(''.join(rand.choice(alphabet)
+                                for _ in range(rand.randint(2, 4))))
+        self.lexicon = sorted(lexicon)
+        self._corpus_coding = StubCoding(rand, self.lexicon)
+        self._enumerated = {}
+
+    def get_categories(self, wb=False):
+        if wb:
+            return CATEGORIES + [WB]
+        return list(CATEGORIES)
+
+    def get_lexicon(self):
+        return [(morph, 1) for morph in self.lexicon]
+
+    def viterbi_nbest(self, word, n):
+        return self._enumerate(word)[:n]
+
+    def viterbi_analyze(self, word):
+        return self.viterbi_nbest(word, 1)[0]
+
+    def forward_logprob(self, word):
+        costs = [cost for (_, cost) in self._enumerate(word)]
+        best = min(costs)
+        return best - math.log(sum(math.exp(best - cost) for cost in costs))
+
+    def _enumerate(self, word):
+        """All analyses of the word, sorted by cost"""
+        if word not in self._enumerated:
+            self._enumerated[word] = sorted(
+                self._analyses(word), key=lambda x: x[1])
+        return self._enumerated[word]
+
+    def _analyses(self, word):
+        coding = self._corpus_coding
+        for cuts in itertools.product([False, True], repeat=len(word) - 1):
+            bounds = ([0] + [i + 1 for (i, cut) in enumerate(cuts) if cut]
+                      + [len(word)])
+            morphs = [word[start:end]
+                      for (start, end) in zip(bounds, bounds[1:])]
+            for cats in itertools.product(CATEGORIES, repeat=len(morphs)):
+                cost = 0.0
+                prev = WB
+                for (morph, cat) in zip(morphs, cats):
+                    emission = coding.emissions.get((cat, morph), None)
+                    if emission is None:
+                        if len(morph) > 1:
+                            break
+                        emission = LOGPROB_ZERO
+                    cost += coding.log_transitionprob(prev, cat) + emission
+                    prev = cat
+                else:
+                    cost += coding.log_transitionprob(prev, WB)
+                    yield ([flatcat.CategorizedMorph(morph, cat)
+                            for (morph, cat) in zip(morphs, cats)],
+                           cost)
+
+
+def same_viterbi(model, word, nbest, viterbi, tolerance=1e-6):
+    """Compares an n-best list to the enumeration.
+    Exactly tied analyses (e.g. repeated morphs with their
+    categories swapped) have no canonical order,
+    so they may come in any order."""
+    expected = model.viterbi_nbest(word, nbest)
+    if viterbi is None or len(expected) != len(viterbi):
+        return False
+    seen = set()
+    for ((_, cost), (analysis, acost)) in zip(expected, viterbi):
+        if abs(cost - acost) > tolerance:
+            return False
+        tied = [tuple(morphs) for (morphs, tcost) in model._enumerate(word)
+                if abs(tcost - acost) <= tolerance]
+        analysis = tuple(analysis)
+        if analysis not in tied or analysis in seen:
+            return False
+        seen.add(analysis)
+    return True
+
+
+def check(name, results, words, model, nbest, forward, tolerance=1e-6):
+    """Number of words for which the results differ from the model"""
+    errors = 0
+    for (word, (viterbi, fwd_cost)) in zip(words, results):
+        ok = True
+        if nbest > 0:
+            ok = same_viterbi(model, word, nbest, viterbi, tolerance)
+        elif viterbi is not None:
+            ok = False
+        if forward:
+            ok = ok and fwd_cost is not None and abs(
+                model.forward_logprob(word) - fwd_cost) <= tolerance
+        elif fwd_cost is not None:
+            ok = False
+        if not ok:
+            errors += 1
+    print('{} (nbest {}, forward {}): {} of {} words differ'.format(
+        name, nbest, forward, errors, len(words)))
+    return errors
+
+
+def main(argv):
+    parser = get_argparser()
+    args = parser.parse_args(argv)
+
+    rand = random.Random(args.seed)
+    alphabet = 'aeikn'
+    model = StubModel(rand, alphabet)
+    words = sorted(set(
+        ''.join(rand.choice(alphabet)
+                for _ in range(rand.randint(1, args.maxlen)))
+        for _ in range(args.num_words)))
+
+    scorers = [
+        ('lattice', lattice.LatticeScorer(model)),
+        ('batch', batchlattice.BatchLatticeScorer(model)),
+        ('prefix', lattice.PrefixLatticeScorer(model))]
+    errors = 0
+    # the combinations used by Selector
+    for (nbest, forward) in [(1, True), (args.nbest, True),
+                             (1, False), (0, True)]:
+        for (name, scorer) in scorers:
+            errors += check(
+                name,
+                [scorer.analyze(word, nbest, forward) for word in words],
+                words, model, nbest, forward)
+            if hasattr(scorer, 'analyze_batch'):
+                # in reverse, so that the batch scorers do the sorting
+                batch = list(reversed(words))
+                errors += check(
+                    '{} batch'.format(name),
+                    scorer.analyze_batch(batch, nbest, forward),
+                    batch, model, nbest, forward)
+    # agrees() also requires ties in the order of the model,
+    # which the enumeration does not define
+    for (name, scorer) in scorers:
+        if not scorer.agrees(model, words):
+            print('{}: agrees() reports a difference'.format(name))
+            errors += 1
+    if errors > 0:
+        raise Exception('The lattice scorers differ from the enumeration')
+    print('All scorers agree with the enumeration')
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
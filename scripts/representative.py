@@ -33,6 +33,32 @@ def get_argparser():
         help='Number of words to select. '
              '(default: %(default)s)')
 
+    add_arg('--tmpdir', dest='tmpdir',
+        metavar='<dir>', default=None,
+        help='Directory for the memory-mapped distance matrix. '
+             '(default: system temporary directory)')
+
+    add_arg('--workers', dest='workers', type=int,
+        metavar='<int>', default=1,
+        help='Number of processes for computing the distances '
+             'and the k-medoids restarts. '
+             '(default: %(default)s)')
+
+    add_arg('--algorithm', dest='algorithm', default='voronoi',
+        choices=representative.ALGORITHMS,
+        help='K-medoids algorithm. clara and bktree need no '
+             'full distance matrix. '
+             '(default: %(default)s)')
+    add_arg('--radius', dest='radius', type=int,
+        metavar='<int>', default=3,
+        help='Neighborhood radius (edit distance) '
+             'of the bktree algorithm. '
+             '(default: %(default)s)')
+    add_arg('--seed', dest='seed', type=int,
+        metavar='<int>', default=None,
+        help='Random seed, for reproducible selections. '
+             '(default: unseeded)')
+
     add_arg('-h', '--help', action='help',
             help="show this help message and exit")
     return parser
@@ -49,7 +75,9 @@ def main(argv):
         parts = words.next().split('\t', 1)
         truncated.append(parts[0])
     selected = representative.representative_sampling(
-        truncated, args.num_annots)
+        truncated, args.num_annots, tmpdir=args.tmpdir,
+        workers=args.workers, algorithm=args.algorithm, seed=args.seed,
+        radius=args.radius)
 
     with codecs.open(args.outfile, 'w', encoding='utf-8') as fobj:
         for word in selected:
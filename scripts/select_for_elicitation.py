@@ -3,11 +3,13 @@ from __future__ import unicode_literals
 
 import argparse
 import codecs
+import collections
 import os
 import sys
 
 import flatcat
-from morphsegannot.tools import tools, selection
+from morphsegannot.tools import tools, selection, featurecache, lattice
+from morphsegannot.tools import modelcache
 
 METRICS = {
     'uncertainty': selection.UncertaintyMetric,
@@ -33,6 +35,13 @@ METRICS = {
     #'alphabracket_logp': 
     #    lambda: selection.AlphaBracketMetric('logp'),
 
+# cheap metrics for the first stage of --cascade
+CASCADE_PROXIES = {
+    'logp': selection.LogpMetric,
+    'ifsubstrings':
+        lambda: selection.IFSubstringMetric(normalize=True, namesuffix='norm', maxlen=4),
+    }
+
 def get_argparser():
     parser = argparse.ArgumentParser(
         prog='select_for_elicitation.py',
@@ -93,12 +102,94 @@ def get_argparser():
             help='Use representative sampling, '
                  'with this many top words as input. '
                  'default: off. 500 is a decent value.')
+    add_arg('--representative-algorithm', dest='repralgorithm',
+            default='voronoi',
+            choices=('voronoi', 'fasterpam', 'clara', 'bktree'),
+            help='K-medoids algorithm for representative sampling. '
+                 'clara and bktree need no full distance matrix. '
+                 '(default: %(default)s)')
+    add_arg('--representative-seed', dest='reprseed', type=int,
+            metavar='<int>', default=None,
+            help='Random seed for representative sampling. '
+                 '(default: unseeded)')
     add_arg('--override-metric-out', dest='overridemetric',
             default=None,
             help='Override metric name in output. '
                  'Useful e.g. for separating representative sampling output.')
 
 
+    add_arg('--greedy-state', dest='greedystate',
+            metavar='<file>', default=None,
+            help='File for saving the state of a greedy ranking '
+                 '(ifsubstrings, oneoffboundary), so that it can be '
+                 'continued with --extend.')
+    add_arg('--extend', dest='extend', type=int,
+            metavar='<int>', default=None,
+            help='Select this many more words by continuing '
+                 'the ranking saved in --greedy-state, '
+                 'appending them to the outputs.')
+    add_arg('--metric-state', dest='metricstate',
+            metavar='<file>', default=None,
+            help='File for saving the configured state of the metric '
+                 '(ifsubstrings). If it exists, it is updated with '
+                 'the changes since the previous iteration instead of '
+                 'configuring from scratch.')
+    add_arg('--streaming', dest='streaming', default=False,
+            action='store_true',
+            help='Only keep the top ranked words in memory: '
+                 'n, or the representative sampling input if larger. '
+                 'Scores are only written for these words. '
+                 'Has no effect on greedy metrics (ifsubstrings, '
+                 'oneoffboundary).')
+    add_arg('--cascade', dest='cascade', type=int,
+            metavar='<int>', default=None,
+            help='Only score the best M*n words according to '
+                 'a cheaper proxy metric (see --cascade-proxy) '
+                 'with the selection metric. '
+                 'n is the representative sampling input if larger. '
+                 'default: off.')
+    add_arg('--cascade-proxy', dest='cascadeproxy', default='logp',
+            choices=sorted(CASCADE_PROXIES.keys()),
+            help='Proxy metric for --cascade. '
+                 '(default: %(default)s)')
+    add_arg('--fused-lattice', dest='fusedlattice', default=False,
+            action='store_true',
+            help='Compute Viterbi and forward costs in a single pass '
+                 'over the lattice of each word. Falls back to the '
+                 'model if the results differ on a sample of words.')
+    add_arg('--batch-lattice', dest='batchlattice', default=False,
+            action='store_true',
+            help='Like --fused-lattice, but scoring words of equal length '
+                 'together, vectorized with numpy. '
+                 'Only Viterbi (1-best) and forward costs are batched.')
+    add_arg('--prefix-lattice', dest='prefixlattice', default=False,
+            action='store_true',
+            help='Like --fused-lattice, but scoring the pool in sorted '
+                 'order, reusing the lattice of the prefix shared '
+                 'with the previous word.')
+    add_arg('--columnar', dest='columnar', default=False,
+            action='store_true',
+            help='Keep the features in numpy arrays instead of '
+                 'per word objects, and score them vectorized. '
+                 'Only for uncertainty, logp, category and nostm. '
+                 'As with --streaming, only the top ranked words '
+                 'are kept, and scores are only written for them.')
+    add_arg('--model-cache', dest='modelcache',
+            metavar='<dir>', default=None,
+            help='Directory for snapshots of the initialized models. '
+                 'Loading a snapshot is faster than reading '
+                 'the model tarball. default: off.')
+    add_arg('--feature-cache', dest='featurecache',
+            metavar='<file>', default=None,
+            help='File for caching the features calculated with the model. '
+                 'Reruns with the same model only calculate '
+                 'the missing features. default: off.')
+    add_arg('--workers', dest='workers', type=int,
+            metavar='<int>', default=1,
+            help='Number of processes for calculating features, '
+                 'and distances in representative sampling. '
+                 '(default: %(default)s)')
+
     add_arg('-h', '--help', action='help',
             help="show this help message and exit")
     return parser
@@ -193,9 +284,14 @@ def main(argv):
     # load, initialize, read
 
     print('Loading model...')
-    model = io.read_tarball_model_file(model_filename)
+    model = modelcache.load_model(io, model_filename, args.modelcache)
     print('...done')
-    model.initialize_hmm()  # FIXME: automate
+
+    cache = None
+    if args.featurecache is not None:
+        cache = featurecache.FeatureCache(
+            args.featurecache,
+            featurecache.model_fingerprint(model_filename))
 
 
     if oldselected_filename is not None:
@@ -214,27 +310,113 @@ def main(argv):
     else:
         oracle = set()
 
-    trainpool = next(tools.get_pools(['train'], args.pooldir))
+    trainpool = next(tools.get_pools(['train'], args.pooldir, compact=True))
 
     # already selected words (incl nonwords) cannot be reselected
     trainpool = tools.filter_pool(trainpool, seen)
 
 
+    scorer = None
+    uselattice = (args.fusedlattice or args.batchlattice
+                  or args.prefixlattice)
+    if uselattice and (metric.need_nbest > 0 or metric.need_forward):
+        print('Reading lattice tables from model...')
+        if args.batchlattice:
+            from morphsegannot.tools import batchlattice
+            scorer = batchlattice.BatchLatticeScorer(model)
+        elif args.prefixlattice:
+            scorer = lattice.PrefixLatticeScorer(model)
+        else:
+            scorer = lattice.LatticeScorer(model)
+        # only used if it reproduces the model exactly
+        if not scorer.agrees(model, trainpool.words[:20],
+                             nbest=metric.need_nbest):
+            print('Fused lattice scorer disagrees with the model, '
+                  'not using it')
+            scorer = None
+        print('...done')
+
     # perform selection
     selector = selection.Selector(
         metric, model,
-        progress=flatcat.utils._generator_progress)
-    if args.configcorpus is not None:
+        progress=flatcat.utils._generator_progress,
+        workers=args.workers,
+        cache=cache,
+        scorer=scorer,
+        columnar=args.columnar)
+    if args.extend is not None:
+        if not hasattr(metric, 'load_ranking'):
+            raise Exception('Only greedy metrics can be extended')
+        if args.greedystate is None or not os.path.exists(args.greedystate):
+            raise Exception('Extending requires an existing --greedy-state')
+        if args.representative is not None and args.representative > 0:
+            raise Exception('Extending does not support '
+                            'representative sampling')
+        print('Loading ranking state "{}"'.format(args.greedystate))
+        metric.load_ranking(args.greedystate)
+    # what the metric is configured on, for updating a saved state
+    use_state = (args.metricstate is not None
+                 and args.extend is None
+                 and hasattr(metric, 'save_state'))
+    corpus = None
+    if use_state:
+        if args.configcorpus is not None:
+            corpus = args.configcorpus
+        else:
+            corpus = collections.Counter(
+                dict(zip(trainpool.words, trainpool.counts)))
+    if use_state and os.path.exists(args.metricstate):
+        old_corpus = metric.load_state(args.metricstate)
+        if isinstance(corpus, collections.Counter) \
+                and isinstance(old_corpus, collections.Counter):
+            print('Updating metric state "{}"'.format(args.metricstate))
+            metric.update(seen,
+                          added=(corpus - old_corpus),
+                          removed=(old_corpus - corpus))
+        elif corpus == old_corpus:
+            print('Updating metric state "{}"'.format(args.metricstate))
+            metric.update(seen)
+        else:
+            print('Metric state "{}" is for another corpus, '
+                  'ignoring it'.format(args.metricstate))
+    if args.configcorpus is not None and not metric.configured:
         print('Configuring metric with "{}"'.format(args.configcorpus))
         selector.configure(
             tools.read_wordlist(args.configcorpus),
             seen=seen)
-    print('Performing ranking...')
-    ranked = selector.rank(trainpool, seen=seen, n=args.num_annots)
+    top = None
+    columnar = args.columnar and hasattr(metric, 'score_columns')
+    if args.streaming or columnar:
+        # with columnar, only the top words get ScoredWords
+        top = max(args.num_annots, args.representative or 0)
+    cascade = None
+    if args.cascade is not None:
+        cascade = (CASCADE_PROXIES[args.cascadeproxy](),
+                   args.cascade * max(args.num_annots,
+                                      args.representative or 0))
+    if args.extend is not None:
+        # the new words are appended to the outputs
+        print('Extending ranking by {}...'.format(args.extend))
+        ranked = metric.extend(args.extend)
+        mode = 'a'
+    else:
+        print('Performing ranking...')
+        ranked = selector.rank(
+            trainpool, seen=seen, n=args.num_annots, top=top,
+            cascade=cascade)
+        mode = 'w'
     print('...done')
+    if args.greedystate is not None and hasattr(metric, 'save_ranking'):
+        metric.save_ranking(args.greedystate)
+    if use_state:
+        metric.save_state(args.metricstate, corpus)
+    if cache is not None:
+        print('Feature cache: {} hits, {} misses'.format(
+            cache.hits, cache.misses))
+        cache.close()
 
     # write scores (debug)
-    selection.write_scores(ranked, scores_filename)
+    selection.write_scores(ranked, scores_filename, mode)
 
     # apply representative sampling, if needed
     if args.representative is not None and args.representative > 0:
@@ -242,14 +424,17 @@ def main(argv):
         from morphsegannot.tools import representative
         truncated = [item.word for item in ranked[:args.representative]]
         selected = representative.representative_sampling(
-            truncated, args.num_annots)
+            truncated, args.num_annots, workers=args.workers,
+            algorithm=args.repralgorithm, seed=args.reprseed)
+    elif args.extend is not None:
+        selected = [item.word for item in ranked]
     else:
         selected = [item.word for item in ranked[:args.num_annots]]
 
     # write
-    with codecs.open(selection_filename, 'w', encoding='utf-8') as selfobj:
-        with codecs.open(unseen_filename, 'w', encoding='utf-8') as unfobj:
-            with codecs.open(prediction_filename, 'w', encoding='utf-8') as prfobj:
+    with codecs.open(selection_filename, mode, encoding='utf-8') as selfobj:
+        with codecs.open(unseen_filename, mode, encoding='utf-8') as unfobj:
+            with codecs.open(prediction_filename, mode, encoding='utf-8') as prfobj:
                 for word in selected:
                     selfobj.write('{}\n'.format(word))
                     if word not in oracle:
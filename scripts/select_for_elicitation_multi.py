@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 
 import argparse
+import multiprocessing
 import os
 import sys
+import time
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import flatcat
-from morphsegannot import tools, selection
+from morphsegannot.tools import tools, selection
+from morphsegannot.tools import modelcache
 
 METRICS = {
     'uncertainty': selection.UncertaintyMetric,
@@ -75,11 +83,117 @@ def get_argparser():
                  'selection metric. '
                  'Useful if not all words are in the training pool.')
 
+    add_arg('--workers', dest='workers', type=int,
+            metavar='<int>', default=1,
+            help='Number of processes for calculating features. '
+                 '(default: %(default)s)')
+    add_arg('--model-cache', dest='modelcache',
+            metavar='<dir>', default=None,
+            help='Directory for snapshots of the initialized models. '
+                 'Loading a snapshot is faster than reading '
+                 'the model tarball. default: off.')
+    add_arg('--jobs', dest='jobs', type=int,
+            metavar='<int>', default=1,
+            help='Number of metrics to run in parallel, '
+                 'each in its own process. Errors are reported '
+                 'per metric instead of stopping the run. '
+                 '(default: %(default)s)')
+
     add_arg('-h', '--help', action='help',
             help="show this help message and exit")
     return parser
 
 
+def select_metric(metric_name, args, trainpool, nonword_filename,
+                  overridemodel=None, shared=None, progress=None):
+    """Performs the selection for one metric"""
+    io = flatcat.FlatcatIO(encoding='utf-8')
+    print('Metric: {}'.format(metric_name))
+    metric = METRICS[metric_name]()
+    # workaround for metric needing high and low models
+    if metric_name.startswith('alphabracket'):
+        metric.set_models(
+            io.read_tarball_model_file(
+                os.path.join(
+                    args.modeldir,
+                    '{}.flatcat.{}_low.model.tar.gz'.format(
+                        args.iteration, 'alphabracket'))),
+            io.read_tarball_model_file(
+                os.path.join(
+                    args.modeldir,
+                    '{}.flatcat.{}_hi.model.tar.gz'.format(
+                        args.iteration, 'alphabracket'))))
+
+    if args.overrideseen is None:
+        annot_filename = os.path.join(
+            args.annotsdir,
+            '{}.train.{}.annotated.words'.format(
+                args.iteration - 1, metric_name))
+    else:
+        annot_filename = args.overrideseen
+    model_filename = None
+    for filename in os.listdir(args.modeldir):
+        if not filename.startswith(
+                '{}.flatcat.{}.'.format(args.iteration, metric_name)):
+            continue
+        if not filename.endswith('.model.tar.gz'):
+            continue
+        if model_filename is not None:
+            raise Exception(
+                'Both "{}" and "{}" match the model pattern'.format(
+                    model_filename, filename))
+        model_filename = os.path.join( args.modeldir, filename)
+    if model_filename is None and args.overridemodel is None:
+        raise Exception('Model for metric "{}" not found'.format(
+            metric_name))
+    selection_filename = os.path.join(
+        args.outdir,
+        '{}.train.{}.selected'.format(args.iteration, metric_name))
+    scores_filename = os.path.join(
+        args.outdir,
+        '{}.train.{}.scores'.format(args.iteration, metric_name))
+
+    if os.path.exists(annot_filename):
+        seen = set(tools.read_wordlist(annot_filename))
+    else:
+        print('No annotations file ({})'.format(annot_filename))
+        seen = set()
+
+    if not nonword_filename is None:
+        nonwords = tools.read_wordlist(nonword_filename)
+    else:
+        nonwords = []
+    seen.update(nonwords)
+    if not overridemodel is None:
+        model = overridemodel
+    elif metric_name.startswith('alphabracket'):
+        model = None
+    else:
+        model = modelcache.load_model(io, model_filename, args.modelcache)
+    # already selected words (incl nonwords) cannot be reselected
+    trainpool = tools.filter_pool(trainpool, seen)
+
+
+    # perform selection
+    selector = selection.Selector(
+        metric, model,
+        progress=progress,
+        workers=args.workers)
+    if args.configcorpus is not None:
+        print('Configuring metric with "{}"'.format(args.configcorpus))
+        selector.configure(
+            tools.read_wordlist(args.configcorpus),
+            seen=seen)
+    print('Performing ranking...')
+    ranked = selector.rank(trainpool, seen=seen, n=args.num_annots,
+                           generic=shared)
+    print('...done')
+
+    # write
+    selection.write_selected(ranked, selection_filename, args.num_annots)
+    selection.write_scores(ranked, scores_filename)
+
+
 def main(argv):
     parser = get_argparser()
     args = parser.parse_args(argv)
@@ -94,9 +208,9 @@ def main(argv):
     overridemodel = None
     if not args.overridemodel is None:
         print('Loading overridemodel...')
-        overridemodel = io.read_tarball_model_file(args.overridemodel)
+        overridemodel = modelcache.load_model(
+            io, args.overridemodel, args.modelcache)
         print('...done')
-        overridemodel.initialize_hmm()  # FIXME: automate
 
     nonword_filename = os.path.join(
         args.annotsdir,
@@ -106,92 +220,105 @@ def main(argv):
             nonword_filename))
         nonword_filename = None
 
-    for metric_name in args.metrics:
-        print('Metric: {}'.format(metric_name))
-        metric = METRICS[metric_name]()
-        # workaround for metric needing high and low models
-        if metric_name.startswith('alphabracket'):
-            metric.set_models(
-                io.read_tarball_model_file(
-                    os.path.join(
-                        args.modeldir,
-                        '{}.flatcat.{}_low.model.tar.gz'.format(
-                            args.iteration, 'alphabracket'))),
-                io.read_tarball_model_file(
-                    os.path.join(
-                        args.modeldir,
-                        '{}.flatcat.{}_hi.model.tar.gz'.format(
-                            args.iteration, 'alphabracket'))))
-
-        if args.overrideseen is None:
-            annot_filename = os.path.join(
-                args.annotsdir,
-                '{}.train.{}.annotated.words'.format(
-                    args.iteration - 1, metric_name))
-        else:
-            annot_filename = args.overrideseen
-        model_filename = None
-        for filename in os.listdir(args.modeldir):
-            if not filename.startswith(
-                    '{}.flatcat.{}.'.format(args.iteration, metric_name)):
-                continue
-            if not filename.endswith('.model.tar.gz'):
-                continue
-            if model_filename is not None:
-                raise Exception(
-                    'Both "{}" and "{}" match the model pattern'.format(
-                        model_filename, filename))
-            model_filename = os.path.join( args.modeldir, filename)
-        if model_filename is None and args.overridemodel is None:
-            raise Exception('Model for metric "{}" not found'.format(
-                metric_name))
-        selection_filename = os.path.join(
-            args.outdir,
-            '{}.train.{}.selected'.format(args.iteration, metric_name))
-        scores_filename = os.path.join(
-            args.outdir,
-            '{}.train.{}.scores'.format(args.iteration, metric_name))
-
-        if os.path.exists(annot_filename):
-            seen = set(tools.read_wordlist(annot_filename))
-        else:
-            print('No annotations file ({})'.format(annot_filename))
-            seen = set()
-
-        if not nonword_filename is None:
-            nonwords = tools.read_wordlist(nonword_filename)
-        else:
-            nonwords = []
-        seen.update(nonwords)
-        if not overridemodel is None:
-            model = overridemodel
-        elif metric_name.startswith('alphabracket'):
-            model = None
-        else:
-            model = io.read_tarball_model_file(model_filename)
-            model.initialize_hmm()
-        trainpool = tools.get_pools(['train'], args.pooldir).next()
-
-        # already selected words (incl nonwords) cannot be reselected
-        trainpool = tools.filter_pool(trainpool, seen)
-
-
-        # perform selection
-        selector = selection.Selector(
-            metric, model,
-            progress=flatcat.utils._generator_progress)
-        if args.configcorpus is not None:
-            print('Configuring metric with "{}"'.format(args.configcorpus))
-            selector.configure(
-                tools.read_wordlist(args.configcorpus),
-                seen=seen)
-        print('Performing ranking...')
-        ranked = selector.rank(trainpool, seen=seen, n=args.num_annots)
-        print('...done')
+    # read once, and shared by the metrics
+    trainpool = next(tools.get_pools(
+        ['train'], args.pooldir, compact=True))
+
+    # with a single model, the model features needed by any of the metrics
+    # are calculated once for the whole pool, and shared
+    shared = None
+    if not overridemodel is None:
+        metrics = [METRICS[metric_name]() for metric_name in args.metrics]
+        if any(metric.need_nbest > 0 or metric.need_forward
+               for metric in metrics):
+            if not nonword_filename is None:
+                nonwords = set(tools.read_wordlist(nonword_filename))
+            else:
+                nonwords = set()
+            print('Calculating shared features...')
+            shared = selection.generic_features(
+                overridemodel, metrics,
+                tools.filter_pool(trainpool, nonwords).words,
+                progress=flatcat.utils._generator_progress,
+                workers=args.workers)
+            print('...done')
+
+    progress = flatcat.utils._generator_progress
+    if args.jobs > 1:
+        # the progress of parallel metrics would be interleaved
+        progress = None
+    jobs = [(metric_name, select_metric,
+             (metric_name, args, trainpool, nonword_filename,
+              overridemodel, shared, progress))
+            for metric_name in args.metrics]
+    if args.jobs > 1:
+        results = run_parallel(jobs, args.jobs)
+    else:
+        results = []
+        for (metric_name, func, func_args) in jobs:
+            start = time.time()
+            func(*func_args)
+            results.append((metric_name, None, time.time() - start))
+
+    failed = 0
+    for (metric_name, error, elapsed) in results:
+        print('{}: {} in {:.1f}s'.format(
+            metric_name, 'failed' if error else 'done', elapsed))
+        if error:
+            failed += 1
+            print(error)
+    if failed > 0:
+        raise Exception('{} of {} metrics failed'.format(
+            failed, len(results)))
+
+
+def run_parallel(jobs, numjobs):
+    """Runs the jobs (name, func, args) in at most numjobs processes.
+    Returns (name, error traceback or None, seconds) for each job,
+    in the order they finished."""
+    # forked children share the model and pool read-only
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        context = multiprocessing
+    results_queue = context.Queue()
+    waiting = list(jobs)
+    running = {}
+    results = []
+    while len(waiting) > 0 or len(running) > 0:
+        while len(waiting) > 0 and len(running) < numjobs:
+            (name, func, func_args) = waiting.pop(0)
+            print('Starting metric: {}'.format(name))
+            proc = context.Process(
+                target=_run_job,
+                args=(results_queue, name, func, func_args))
+            proc.start()
+            running[name] = (proc, time.time())
+        try:
+            (name, error, elapsed) = results_queue.get(timeout=1)
+        except queue.Empty:
+            # a process dying without reporting would block forever
+            for (name, (proc, start)) in list(running.items()):
+                if proc.exitcode is not None and proc.exitcode != 0:
+                    del running[name]
+                    results.append((
+                        name,
+                        'Process exited with code {}'.format(proc.exitcode),
+                        time.time() - start))
+            continue
+        running.pop(name)[0].join()
+        results.append((name, error, elapsed))
+    return results
+
 
-        # write
-        selection.write_selected(ranked, selection_filename, args.num_annots)
-        selection.write_scores(ranked, scores_filename)
+def _run_job(results_queue, name, func, func_args):
+    start = time.time()
+    error = None
+    try:
+        func(*func_args)
+    except Exception:
+        error = traceback.format_exc()
+    results_queue.put((name, error, time.time() - start))
 
 
 if __name__ == "__main__":